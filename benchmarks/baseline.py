@@ -0,0 +1,115 @@
+"""
+Original implementations of the statistics and the scoring, used as references by the benchmarks.
+
+get_daily, get_score and BaselineStats.get are verbatim copies of the first version of scores.py and data.py: the raw
+prediction is interpolated in a dict and the scores are computed from the ISO dates and text values of the csv file.
+Only pure functions are memoized, so that the references can be computed for thousands of predictions.
+"""
+import datetime
+import functools
+import logging
+
+import matplotlib.dates
+
+# the same date is converted for every predicted day
+date2num = functools.lru_cache(maxsize=None)(matplotlib.dates.date2num)
+
+
+class BaselineStats:
+    """Statistics read from a csv file like the original CPGameData.update_stats."""
+
+    def __init__(self, path: str):
+        with open(path) as f:
+            lines = f.readlines()
+        self.titles = lines[0][:-1].split(",")
+        self.values = tuple(line[:-1].split(",")[:7] for line in lines[1:])  # discard right part of the table
+        self._cache = dict()
+
+    def get(self, *titles, **filters) -> list:
+        # every prediction of a location reads the same rows
+        key = titles, tuple(sorted(filters.items()))
+        if key not in self._cache:
+            self._cache[key] = self._get(*titles, **filters)
+        return self._cache[key]
+
+    def _get(self, *titles, **filters) -> list:
+        """
+        Return certain information from the dataset.
+
+        Column titles and explanations:
+        https://github.com/owid/covid-19-data/blob/master/public/data/owid-covid-codebook.csv
+
+        :param titles: titles of the columns to return
+        :param filters: values in certain columns to search for
+        :return: list with rows, whereas each row is a list of values in order of the given column titles
+        """
+
+        for filter_title in filters.keys():
+            if filter_title not in self.titles:
+                raise ValueError(f"'{filter_title}' is not a valid filter.")
+
+        res = []
+        res_indices = [self.titles.index(arg) for arg in titles]
+
+        def filter_row(values):
+            return [values[i] for i in res_indices]
+
+        for row in self.values:
+            for title, value in zip(self.titles, row):
+                if title in filters.keys() and value != str(filters[title]):
+                    break
+            else:
+                res.append(filter_row(row))
+
+        return res
+
+
+def get_daily(prediction: dict) -> dict:
+    """Convert a raw prediction into a series of numbers, one for each predicted day."""
+    current_date, *_, end_date = dates = list(prediction.keys())
+    index = 0
+    daily_predictions = dict()
+
+    # bugfix for older profiles
+    if dates[0] > dates[1]:
+        current_date = dates[1]
+
+    while current_date < end_date:
+        if current_date > dates[index + 1]:
+            index += 1
+        else:
+            timespan = dates[index + 1] - dates[index]
+            weight1 = dates[index + 1] - current_date
+            weight2 = current_date - dates[index]
+            cases = (prediction[dates[index]] * weight1 + prediction[dates[index + 1]] * weight2) / timespan
+
+            if cases < 0: cases = 0
+
+            daily_predictions[int(current_date)] = cases
+            current_date += 1
+    return daily_predictions
+
+
+def get_score(country, covid_stats, daily_predictions: dict) -> (float, float, float):
+    """Get the total and daily score of a user."""
+    data = covid_stats.get("date", "new_cases_smoothed", location=country)
+    score = days = last_score = 0
+    for i, (date_pred, cases_pred) in enumerate(daily_predictions.items()):
+        for date_actual, cases_actual in data:
+            if date_pred == date2num(datetime.date.fromisoformat(date_actual)):
+                try:
+                    cases_actual = float(cases_actual)
+                except ValueError:
+                    logging.error(
+                        f"No valid data for {country} available.")
+                else:
+                    if cases_actual == 0 or cases_pred == 0:
+                        last_score = cases_actual == cases_pred
+                    else:
+                        last_score = min(cases_actual / cases_pred,cases_pred / cases_actual)
+                    score += last_score
+                    days += 1
+                    break
+        else:
+            break
+    return float(score), float(score)/(days if score else 1), float(last_score), days
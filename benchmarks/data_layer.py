@@ -0,0 +1,104 @@
+"""
+Benchmark of the statistics layer (data.py).
+
+Generates OWID-shaped csv files, serves them from a local HTTP server and measures the time and peak memory of
+loading the statistics (download and parsing as well as loading from the binary cache) and the latency of typical
+queries. Results are written as JSON lines.
+
+usage: python -m benchmarks.data_layer [--locations 50 200] [--days 1000] [--columns 60] [--missing 0.05]
+"""
+import argparse
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import data
+from benchmarks.synthetic import write_owid_csv, location_names
+from benchmarks.utils import local_server, timed, peak_memory, percentiles, emit
+
+
+def fresh_stats(directory: str) -> data.CovidStats:
+    """Download and parse the statistics without any cached files."""
+    shutil.rmtree(directory, ignore_errors=True)
+    return data.load_stats()
+
+
+def query_latencies(stats: data.CovidStats, locations: list, dates: list, n_queries: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    queries = {
+        'get_location': lambda: stats.get("date", "new_cases_smoothed", location=rng.choice(locations)),
+        'get_location_date': lambda: stats.get("new_cases_smoothed", location=rng.choice(locations),
+                                                date=rng.choice(dates)),
+        'get_date': lambda: stats.get("location", "new_cases_smoothed", date=rng.choice(dates)),
+        'get_series': lambda: stats.get_series(rng.choice(locations)),
+        'get_lazy_column': lambda: stats.get("date", "total_deaths", location=rng.choice(locations)),
+    }
+    results = dict()
+    for name, query in queries.items():
+        query()  # warm up (e.g. parse lazily loaded columns)
+        samples = []
+        for _ in range(n_queries if name != "get_date" else max(1, n_queries // 10)):
+            start = time.perf_counter()
+            query()
+            samples.append(time.perf_counter() - start)
+        results[name] = percentiles(samples)
+    return results
+
+
+def run(n_locations: int, n_days: int, n_columns: int, missing_rate: float, n_queries: int, repeat: int, seed: int,
+        output: str = None):
+    params = {
+        'locations': n_locations,
+        'days': n_days,
+        'columns': n_columns,
+        'missing_rate': missing_rate,
+        'rows': n_locations * n_days,
+    }
+    with tempfile.TemporaryDirectory() as root:
+        source_directory = f"{root}/source"
+        os.makedirs(source_directory)
+        write_owid_csv(f"{source_directory}/owid.csv", n_locations, n_days, n_columns, missing_rate, seed)
+        params['csv_bytes'] = os.path.getsize(f"{source_directory}/owid.csv")
+
+        with local_server(source_directory) as url:
+            data.CSV_SOURCE = f"{url}/owid.csv"
+            data.TEMP_DIR = f"{root}/covid_data"
+
+            cold_time, _ = timed(fresh_stats, data.TEMP_DIR, repeat=repeat)
+            cold_memory, _ = peak_memory(fresh_stats, data.TEMP_DIR)
+            cached_time, _ = timed(data.load_stats, repeat=repeat)
+            cached_memory, stats = peak_memory(data.load_stats)
+
+            dates = [(datetime.date.today() - datetime.timedelta(days=i + 1)).isoformat() for i in range(n_days)]
+            results = {
+                'load_download_parse_s': cold_time,
+                'load_download_parse_peak_bytes': cold_memory,
+                'load_cached_s': cached_time,
+                'load_cached_peak_bytes': cached_memory,
+                'queries': query_latencies(stats, location_names(n_locations), dates, n_queries, seed),
+            }
+    emit("data_layer", params, results, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--locations", type=int, nargs="+", default=[50, 200], help="numbers of locations")
+    parser.add_argument("--days", type=int, nargs="+", default=[1000], help="numbers of days per location")
+    parser.add_argument("--columns", type=int, default=60, help="number of columns in the csv file")
+    parser.add_argument("--missing", type=float, default=0.05, help="rate of missing values")
+    parser.add_argument("--queries", type=int, default=1000, help="number of queries per query type")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of the timed loading steps")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append the results to this file instead of printing them")
+    args = parser.parse_args()
+
+    for n_locations in args.locations:
+        for n_days in args.days:
+            run(n_locations, n_days, args.columns, args.missing, args.queries, args.repeat, args.seed, args.output)
+
+
+if __name__ == "__main__":
+    main()
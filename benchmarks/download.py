@@ -0,0 +1,140 @@
+"""
+Check of the download of the statistics (data.download) against a local server.
+
+Serves a synthetic OWID csv file and downloads it in the situations left behind by earlier runs of the bot: no files
+(200), an unchanged copy of the day before (304), an interrupted download (206), a complete partial file that was not
+renamed (416), a partial file longer than the remote file (416, then 200) and a partial file of an older version of the
+remote file (200). For every situation, the status codes of the responses, whether the downloaded file equals the remote
+one and the latency of the download are reported as JSON lines. Exits with 1 if any situation fails.
+
+usage: python -m benchmarks.download [--locations 50] [--days 1000]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import data
+from benchmarks.synthetic import write_owid_csv
+from benchmarks.utils import local_server, QuietHandler, percentiles, emit
+
+
+class RecordingHandler(QuietHandler):
+    # status codes of the responses sent since the last reset
+    statuses = []
+
+    def log_request(self, code="-", size="-"):
+        self.statuses.append(int(code))
+
+
+def write(path: str, content: bytes, validators: dict):
+    """Write a file and the validators of its download."""
+    with open(path, "wb") as f:
+        f.write(content)
+    with open(f"{path}.json", "w") as f:
+        json.dump(validators, f)
+
+
+def no_files(directory, content, validators):
+    return None
+
+
+def unchanged(directory, content, validators):
+    write(f"{directory}/yesterday.csv", content, validators)
+    return f"{directory}/yesterday.csv"
+
+
+def interrupted(directory, content, validators):
+    write(f"{directory}/download.part", content[:len(content) // 2], validators)
+
+
+def not_renamed(directory, content, validators):
+    write(f"{directory}/download.part", content, validators)
+
+
+def oversized(directory, content, validators):
+    write(f"{directory}/download.part", content + content[:1000], validators)
+
+
+def outdated(directory, content, validators):
+    write(f"{directory}/download.part", b"x" * (len(content) // 2), {'ETag': '"outdated"'})
+
+
+# name: (creates the files and returns the previous copy, expected status codes, expected return value)
+SCENARIOS = {
+    'no files': (no_files, [200], True),
+    'unchanged': (unchanged, [304], False),
+    'interrupted': (interrupted, [206], True),
+    'not renamed': (not_renamed, [416], True),
+    'oversized part': (oversized, [416, 200], True),
+    'outdated part': (outdated, [200], True),
+}
+
+
+def check(scenario, url: str, directory: str, content: bytes, validators: dict, repeat: int) -> dict:
+    prepare, expected_statuses, expected_result = scenario
+    samples = []
+    passed = True
+    for _ in range(repeat):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        previous = prepare(directory, content, validators)
+        RecordingHandler.statuses.clear()
+        start = time.perf_counter()
+        downloaded = data.download(url, f"{directory}/today.csv", previous)
+        samples.append(time.perf_counter() - start)
+
+        with open(f"{directory}/today.csv", "rb") as f:
+            complete = f.read() == content
+        statuses = list(RecordingHandler.statuses)
+        passed &= statuses == expected_statuses and downloaded == expected_result and complete and \
+            not os.path.exists(f"{directory}/download.part")
+    return {
+        'statuses': statuses,
+        'downloaded': downloaded,
+        'complete': complete,
+        'passed': passed,
+        **percentiles(samples),
+    }
+
+
+def run(n_locations: int, n_days: int, repeat: int, seed: int, output: str = None) -> dict:
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(f"{root}/remote")
+        write_owid_csv(f"{root}/remote/owid.csv", n_locations, n_days, n_columns=10, missing_rate=0, seed=seed)
+        with open(f"{root}/remote/owid.csv", "rb") as f:
+            content = f.read()
+        params = {
+            'locations': n_locations,
+            'days': n_days,
+            'csv_bytes': len(content),
+        }
+
+        with local_server(f"{root}/remote", RecordingHandler) as url:
+            # the validators the server sends with the file
+            data.download(f"{url}/owid.csv", f"{root}/first.csv")
+            validators = data.read_validators(f"{root}/first.csv")
+            results = {name: check(scenario, f"{url}/owid.csv", f"{root}/{name}", content, validators, repeat)
+                       for name, scenario in SCENARIOS.items()}
+    emit("download", params, results, output)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--locations", type=int, default=50, help="number of locations in the csv file")
+    parser.add_argument("--days", type=int, default=1000, help="number of days per location")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of every situation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append the results to this file instead of printing them")
+    args = parser.parse_args()
+
+    results = run(args.locations, args.days, args.repeat, args.seed, args.output)
+    sys.exit(0 if all(result['passed'] for result in results.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
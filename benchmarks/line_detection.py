@@ -0,0 +1,205 @@
+"""
+Accuracy and latency benchmark of the line detection.
+
+Renders input charts of synthetic statistics with charts.visualize(mode="input") at several resolutions and draws lines
+of known shape on them, varying the stroke (thickness, color, double strokes) and the photo (JPEG quality,
+recompression, noise). Every drawing is fed through line_detection.evaluate and the detected prediction is compared
+with the drawn line day by day. For every resolution and variant, the relative error per day |detected - drawn| / drawn
+(mean, p50, p95, max), its mean signed value (bias), the share of days and drawings without a detected value and the
+latency and peak memory of evaluate are reported as JSON lines.
+
+variants (one property of the baseline stroke or photo changed at a time):
+    baseline         red stroke of 4 pixels at 100 dpi, JPEG quality 85
+    width 1/12       thinner and thicker strokes
+    black/blue/yellow  other stroke colors
+    double stroke    two strokes 4 pixels apart, the drawn line is in the middle
+    jpeg 50          low JPEG quality
+    recompressed     saved three times with JPEG quality 75, like a photo that was forwarded
+    noise 8/20       gaussian noise of the given standard deviation on every color channel
+
+usage: python -m benchmarks.line_detection [--dpi 100 150 200] [--locations 4] [--max-error 0.05]
+"""
+import argparse
+import io
+import logging
+import math
+import sys
+import tempfile
+import warnings
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import charts
+import data
+import line_detection
+import scores
+from benchmarks.synthetic import write_owid_csv, location_names
+from benchmarks.utils import timed, peak_memory, percentiles, emit
+from constants import N_PREDICTED_DAYS
+
+# fraction of the height of the drawing area over the fraction t of the predicted days
+SHAPES = {
+    'rise': lambda t: 0.2 + 0.6 * t,
+    'decline': lambda t: 0.8 - 0.6 * t,
+    'flat': lambda t: 0.5,
+    'wave': lambda t: 0.5 + 0.3 * math.sin(2 * math.pi * t),
+    'peak': lambda t: 0.15 + 0.7 * math.exp(-((t - 0.4) / 0.2) ** 2),
+}
+# sizes are given in pixels at 100 dpi and scaled with the resolution
+BASELINE = {'width': 4, 'color': (255, 0, 0), 'double': 0, 'quality': 85, 'saves': 1, 'noise': 0}
+VARIANTS = {
+    'baseline': {},
+    'width 1': {'width': 1},
+    'width 12': {'width': 12},
+    'black': {'color': (0, 0, 0)},
+    'blue': {'color': (0, 0, 255)},
+    'yellow': {'color': (255, 220, 0)},
+    'double stroke': {'double': 4},
+    'jpeg 50': {'quality': 50},
+    'recompressed': {'quality': 75, 'saves': 3},
+    'noise 8': {'noise': 8},
+    'noise 20': {'noise': 20},
+}
+
+
+class InputChart:
+    """Rendered input chart of a location and the mapping between its pixels and the predicted days."""
+
+    def __init__(self, location: str, stats: data.CovidStats, dpi: int, chart_scale=1.5):
+        self.location = location
+        chart = io.BytesIO()
+        self.drawing_area = charts.visualize([location], stats, chart, mode="input", chart_scale=chart_scale, dpi=dpi)
+        self.image = chart.getvalue()
+        self.reference = line_detection.decode_reference(io.BytesIO(self.image))
+        self.height, self.width = self.reference.shape
+        self.last_date = stats.get_series(location).dates[-1]
+
+    def truth(self, shape) -> (np.ndarray, np.ndarray):
+        """Return the date numbers of the predicted days and the values of the shape on them."""
+        x0, y0, x1, y1, x_factor, y_factor = self.drawing_area
+        n_days = int((x1 - x0) * x_factor)
+        days = np.arange(1, n_days + 1)
+        values = np.array([shape(day / n_days) for day in days]) * (y1 - y0) * y_factor
+        return self.last_date + days, values
+
+    def stroke(self, shape, shift=0.0) -> list:
+        """Return the pixels (x, y) of the shape in the image, shifted upwards by the given number of pixels."""
+        x0, y0, x1, y1, x_factor, y_factor = self.drawing_area
+        points = []
+        for x in range(math.ceil(x0), math.floor(x1) + 1):
+            # the axes have their origin at the bottom of the figure, the image at the top
+            y = y0 + shape((x - x0) / (x1 - x0)) * (y1 - y0)
+            points.append((x, self.height - y - shift))
+        return points
+
+
+def draw(chart: InputChart, shape, variant: dict, scale: float, rng: np.random.Generator) -> bytes:
+    """Draw the shape on the chart and return the photo as it would be uploaded."""
+    variant = {**BASELINE, **variant}
+    image = Image.open(io.BytesIO(chart.image)).convert("RGB")
+    canvas = ImageDraw.Draw(image)
+    width = max(round(variant['width'] * scale), 1)
+    shifts = (-variant['double'] * scale / 2, variant['double'] * scale / 2) if variant['double'] else (0,)
+    for shift in shifts:
+        canvas.line(chart.stroke(shape, shift), fill=variant['color'], width=width, joint="curve")
+
+    if variant['noise']:
+        pixels = np.asarray(image, dtype=np.float32) + rng.normal(0, variant['noise'], (chart.height, chart.width, 3))
+        image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    for _ in range(variant['saves']):
+        photo = io.BytesIO()
+        image.save(photo, format="jpeg", quality=variant['quality'])
+        image = Image.open(photo)
+    return photo.getvalue()
+
+
+def run_variant(charts_: list, stats: data.CovidStats, variant: dict, scale: float, repeat: int, seed: int) -> dict:
+    rng = np.random.default_rng(seed)
+    errors, latencies, memory = [], [], 0
+    failed = missing = n_days = 0
+    for chart in charts_:
+        for shape in SHAPES.values():
+            photo = draw(chart, shape, variant, scale, rng)
+
+            def detect():
+                return line_detection.evaluate(io.BytesIO(photo), chart.location, chart.drawing_area, stats,
+                                               chart.reference)
+
+            elapsed, detected = timed(detect, repeat=repeat)
+            latencies.append(elapsed)
+            memory = max(memory, peak_memory(detect)[0])
+
+            days, expected = chart.truth(shape)
+            n_days += len(days)
+            if type(detected) == str:
+                failed += 1
+                missing += len(days)
+                continue
+            values = scores.interpolate(detected).values_at(days)
+            found = ~np.isnan(values)
+            missing += int(np.sum(~found))
+            errors.append((values[found] - expected[found]) / expected[found])
+
+    errors = np.concatenate(errors) if errors else np.zeros(0)
+    absolute = np.abs(errors)
+    return {
+        'mean_error': float(np.mean(absolute)) if len(errors) else None,
+        'p50_error': float(np.percentile(absolute, 50)) if len(errors) else None,
+        'p95_error': float(np.percentile(absolute, 95)) if len(errors) else None,
+        'max_error': float(np.max(absolute)) if len(errors) else None,
+        'bias': float(np.mean(errors)) if len(errors) else None,
+        'missing_days': missing / n_days,
+        'failed_drawings': failed,
+        **percentiles(latencies),
+        'peak_bytes': memory,
+    }
+
+
+def run(dpi: int, n_locations: int, repeat: int, seed: int, output: str = None) -> dict:
+    with tempfile.TemporaryDirectory() as root:
+        # the charts end with the statistics of yesterday, like the downloaded ones
+        write_owid_csv(f"{root}/owid.csv", n_locations, n_days=500, n_columns=10, missing_rate=0, seed=seed)
+        stats = data.CovidStats(f"{root}/owid.csv")
+        input_charts = [InputChart(location, stats, dpi) for location in location_names(n_locations)]
+        params = {
+            'dpi': dpi,
+            'size': [input_charts[0].width, input_charts[0].height],
+            'locations': n_locations,
+            'shapes': list(SHAPES),
+            'predicted_days': N_PREDICTED_DAYS,
+            'seed': seed,
+        }
+        results = {name: run_variant(input_charts, stats, variant, dpi / 100, repeat, seed)
+                   for name, variant in VARIANTS.items()}
+    emit("line_detection", params, results, output)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dpi", type=int, nargs="+", default=[100, 150, 200],
+                        help="resolutions of the charts (100 is the one sent to the users)")
+    parser.add_argument("--locations", type=int, default=4, help="number of locations with a chart each")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of every latency measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-error", type=float,
+                        help="exit with 1 if the mean relative error of any variant exceeds this value")
+    parser.add_argument("--output", help="append the results to this file instead of printing them")
+    args = parser.parse_args()
+
+    # undetected lines are expected for some of the variants
+    logging.disable(logging.ERROR)
+    # input charts have no predicted values
+    warnings.filterwarnings("ignore", message="All-NaN axis encountered")
+    passed = True
+    for dpi in args.dpi:
+        results = run(dpi, args.locations, args.repeat, args.seed, args.output)
+        if args.max_error is not None:
+            passed &= all(result['mean_error'] is not None and result['mean_error'] <= args.max_error
+                          for result in results.values())
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
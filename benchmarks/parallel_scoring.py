@@ -0,0 +1,63 @@
+"""
+Benchmark of the nightly score computation with different numbers of worker processes.
+
+Generates OWID-shaped statistics and predictions of synthetic users, scores all predictions with
+scores.score_all(..., workers=n) and reports the wall time and the speedup compared to scoring in the main process.
+The results of every run are checked against the serial ones. Results are written as JSON lines.
+
+usage: python -m benchmarks.parallel_scoring [--predictions 10000 100000] [--workers 1 2 4 8]
+"""
+import argparse
+import os
+import tempfile
+
+import data
+import scores
+from benchmarks.synthetic import write_owid_csv, make_predictions
+from benchmarks.utils import timed, emit
+
+
+def run(n_predictions: int, n_locations: int, n_days: int, workers: list, repeat: int, seed: int, output: str = None):
+    params = {
+        'predictions': n_predictions,
+        'locations': n_locations,
+        'days': n_days,
+        'cpu_count': os.cpu_count(),
+    }
+    with tempfile.TemporaryDirectory() as root:
+        write_owid_csv(f"{root}/owid.csv", n_locations, n_days, n_columns=10, missing_rate=0, seed=seed)
+        stats = data.CovidStats(f"{root}/owid.csv")
+        predictions = {key: scores.interpolate(prediction) for key, prediction in
+                       make_predictions(n_predictions, n_locations, max_age=n_days - 150, seed=seed).items()}
+
+        serial_time, expected = timed(scores.score_all, predictions, stats, repeat=repeat)
+        results = {'serial_s': serial_time, 'workers': dict()}
+        for n_workers in workers:
+            parallel_time, res = timed(scores.score_all, predictions, stats, workers=n_workers, repeat=repeat)
+            results['workers'][n_workers] = {
+                'time_s': parallel_time,
+                'speedup': serial_time / parallel_time,
+                'identical': res == expected,
+            }
+    emit("parallel_scoring", params, results, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--predictions", type=int, nargs="+", default=[10_000, 100_000], help="numbers of predictions")
+    parser.add_argument("--workers", type=int, nargs="+", help="numbers of worker processes (default: powers of two "
+                                                               "up to the number of cores)")
+    parser.add_argument("--locations", type=int, default=200, help="number of locations")
+    parser.add_argument("--days", type=int, default=600, help="number of days per location")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of every measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append the results to this file instead of printing them")
+    args = parser.parse_args()
+
+    workers = args.workers or [2 ** i for i in range((os.cpu_count() or 1).bit_length())]
+    for n_predictions in args.predictions:
+        run(n_predictions, args.locations, args.days, workers, args.repeat, args.seed, args.output)
+
+
+if __name__ == "__main__":
+    main()
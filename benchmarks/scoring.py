@@ -0,0 +1,152 @@
+"""
+Regression check and benchmark of the score computation.
+
+Generates OWID-shaped statistics and raw predictions of synthetic users and computes reference scores for a sample of
+them with the original implementation (see benchmarks.baseline), one prediction at a time on the text values of the
+csv file. Every engine must reproduce the reference scores within the tolerance (the predictions are stored as float32
+since the scores are computed incrementally); its throughput (predictions scored per second) and peak memory are
+reported as JSON lines. The exit code is 1 if any engine deviates.
+
+engines:
+    get_score        scores.get_daily and scores.get_score, one prediction at a time
+    score_all        interpolating and scoring all predictions in batches grouped by country
+    incremental      score_all on the stored daily series, continuing from the running totals of the previous day
+
+usage: python -m benchmarks.scoring [--predictions 1000 10000 100000] [--tolerance 1e-6] [--reference-sample 500]
+"""
+import argparse
+import logging
+import random
+import sys
+import tempfile
+
+import numpy as np
+
+import data
+import scores
+from benchmarks import baseline
+from benchmarks.synthetic import write_owid_csv, make_predictions
+from benchmarks.utils import timed, peak_memory, emit
+
+
+class PreviousDay:
+    """Statistics as they were one day before: the last reported day of every location is missing."""
+
+    def __init__(self, stats: data.CovidStats):
+        self.stats = stats
+
+    def get_series(self, location: str, column: str = "new_cases_smoothed") -> data.TimeSeries:
+        series = self.stats.get_series(location, column)
+        return data.TimeSeries(series.ordinals[:-1], series.dates[:-1], series.values[:-1])
+
+
+def baseline_engine(raw_predictions: dict, stats: baseline.BaselineStats) -> dict:
+    return {key: baseline.get_score(key[1], stats, baseline.get_daily(prediction))
+            for key, prediction in raw_predictions.items()}
+
+
+def get_score_engine(raw_predictions: dict, stats) -> dict:
+    return {key: scores.get_score(key[1], stats, scores.get_daily(prediction))
+            for key, prediction in raw_predictions.items()}
+
+
+def batch_engine(raw_predictions: dict, stats) -> dict:
+    return scores.score_all({key: scores.interpolate(prediction) for key, prediction in raw_predictions.items()}, stats)
+
+
+def incremental_engine(raw_predictions: dict, stats, daily: dict, previous: (dict, dict)) -> dict:
+    """Score the stored daily series from the states and checksums of the previous day, as in update_database."""
+    states, checksums = previous
+    return scores.score_all(daily, stats, states, dict(checksums))
+
+
+def previous_day_state(daily: dict, stats) -> (dict, dict):
+    checksums = dict()
+    results = scores.score_all(daily, PreviousDay(stats), dict(), checksums)
+    states = {key: scores.ScoreState(score, days, daily[key].start + days - 1, last_score)
+              for key, (score, _, last_score, days) in results.items()}
+    return states, checksums
+
+
+def compare(results: dict, reference: dict, tolerance: float) -> dict:
+    keys = list(reference)
+    expected = np.array([reference[key] for key in keys], dtype=np.float64)
+    actual = np.array([results.get(key, (np.nan,) * 4) for key in keys], dtype=np.float64)
+    close = np.isclose(actual, expected, rtol=tolerance, atol=tolerance)
+    errors = np.abs(actual - expected)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relative_errors = np.where(errors == 0, 0, errors / np.abs(expected))
+    return {
+        'mismatches': int(np.sum(~close.all(axis=1))),
+        'max_abs_error': float(np.nanmax(errors)) if len(keys) else 0.0,
+        'max_rel_error': float(np.nanmax(relative_errors)) if len(keys) else 0.0,
+    }
+
+
+def run(n_predictions: int, n_locations: int, n_days: int, tolerance: float, n_reference: int, seed: int,
+        output: str = None) -> bool:
+    params = {
+        'predictions': n_predictions,
+        'locations': n_locations,
+        'days': n_days,
+        'seed': seed,
+        'tolerance': tolerance,
+        'reference_sample': min(n_reference, n_predictions),
+    }
+    with tempfile.TemporaryDirectory() as root:
+        write_owid_csv(f"{root}/owid.csv", n_locations, n_days, n_columns=10, missing_rate=0.001, seed=seed)
+        stats = data.CovidStats(f"{root}/owid.csv")
+        raw_predictions = make_predictions(n_predictions, n_locations, max_age=n_days - 150, seed=seed)
+
+        # the original implementation is too slow for all predictions, the engines are compared on a sample
+        sample = random.Random(seed).sample(list(raw_predictions), min(n_reference, len(raw_predictions)))
+        elapsed, reference = timed(baseline_engine, {key: raw_predictions[key] for key in sample},
+                                   baseline.BaselineStats(f"{root}/owid.csv"))
+        results = {'baseline': {'time_s': elapsed, 'predictions_per_s': len(sample) / elapsed}}
+
+        daily = {key: scores.interpolate(prediction) for key, prediction in raw_predictions.items()}
+        engines = {
+            'get_score': (get_score_engine, ()),
+            'score_all': (batch_engine, ()),
+            'incremental': (incremental_engine, (daily, previous_day_state(daily, stats))),
+        }
+        passed = True
+        for name, (engine, args) in engines.items():
+            elapsed, res = timed(engine, raw_predictions, stats, *args)
+            memory, _ = peak_memory(engine, raw_predictions, stats, *args)
+            results[name] = {
+                'time_s': elapsed,
+                'predictions_per_s': n_predictions / elapsed,
+                'peak_bytes': memory,
+                **compare(res, reference, tolerance),
+            }
+            passed &= results[name]['mismatches'] == 0
+    emit("scoring", params, results, output)
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--predictions", type=int, nargs="+", default=[1000, 10_000, 100_000],
+                        help="numbers of predictions")
+    parser.add_argument("--locations", type=int, default=200, help="number of locations")
+    parser.add_argument("--days", type=int, default=600, help="number of days per location")
+    parser.add_argument("--tolerance", type=float, default=1e-6,
+                        help="relative and absolute tolerance of the scores (default: float32 precision)")
+    parser.add_argument("--reference-sample", type=int, default=500,
+                        help="number of predictions scored with the original implementation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append the results to this file instead of printing them")
+    args = parser.parse_args()
+
+    # days without valid data are expected in the synthetic statistics
+    logging.disable(logging.ERROR)
+    passed = True
+    for n_predictions in args.predictions:
+        passed &= run(n_predictions, args.locations, args.days, args.tolerance, args.reference_sample, args.seed,
+                      args.output)
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import datetime
+import math
+import random
+
+from matplotlib.dates import date2num
+
+# leading columns of the OWID dataset, further columns are filled with generic metrics
+OWID_COLUMNS = ("iso_code", "continent", "location", "date", "total_cases", "new_cases", "new_cases_smoothed",
+                "total_deaths", "new_deaths", "new_deaths_smoothed")
+CONTINENTS = ("Africa", "Asia", "Europe", "North America", "Oceania", "South America")
+
+
+def location_names(n_locations: int) -> list:
+    """Return the names of the generated locations, starting with "World"."""
+    return ["World"] + [f"Country {i}" for i in range(1, n_locations)]
+
+
+def write_owid_csv(path: str, n_locations=200, n_days=1000, n_columns=60, missing_rate=0.05, seed=0,
+                   end_date: datetime.date = None):
+    """
+    Write a csv file with the same layout as the OWID dataset.
+
+    Every location gets a smooth wave of new cases with some noise. Numeric values are missing with the given
+    probability (except for the first two days of each location, so that there is always some data).
+
+    :param path: destination of the file
+    :param n_locations: number of locations (including "World")
+    :param n_days: number of days per location, ending at end_date
+    :param n_columns: total number of columns (at least the four leading text and date columns)
+    :param missing_rate: probability of an empty numeric cell
+    :param seed: seed of the random number generator
+    :param end_date: last date in the file (yesterday by default)
+    """
+    rng = random.Random(seed)
+    if end_date is None:
+        end_date = datetime.date.today() - datetime.timedelta(days=1)
+    n_columns = max(n_columns, 4)
+    titles = list(OWID_COLUMNS[:n_columns]) + [f"metric_{i}" for i in range(n_columns - len(OWID_COLUMNS))]
+    dates = [(end_date - datetime.timedelta(days=n_days - 1 - i)).isoformat() for i in range(n_days)]
+
+    with open(path, "w") as f:
+        f.write(",".join(titles) + "\n")
+        for i, location in enumerate(location_names(n_locations)):
+            iso_code = "OWID_WRL" if location == "World" else f"C{i:03d}"
+            continent = "" if location == "World" else rng.choice(CONTINENTS)
+            scale = rng.uniform(10, 10_000) * (50 if location == "World" else 1)
+            period = rng.uniform(60, 240)
+            phase = rng.uniform(0, 2 * math.pi)
+            total = 0.0
+            for day, date in enumerate(dates):
+                smoothed = scale * (1.1 + math.sin(day / period * 2 * math.pi + phase))
+                new = max(0.0, smoothed * rng.uniform(0.7, 1.3))
+                total += new
+                values = [total, new, smoothed, total / 50, new / 50, smoothed / 50]
+                values += [rng.uniform(0, 100) for _ in range(n_columns - len(OWID_COLUMNS))]
+                cells = [iso_code, continent, location, date]
+                for value in values[:n_columns - 4]:
+                    cells.append("" if day > 1 and rng.random() < missing_rate else f"{value:.3f}")
+                f.write(",".join(cells) + "\n")
+
+
+def make_predictions(n_predictions=10_000, n_locations=200, max_age=400, seed=0,
+                     end_date: datetime.date = None) -> dict:
+    """
+    Generate raw predictions in the format of line_detection.evaluate (date number: cases), spread over users.
+
+    Every user predicts one to five of the locations written by write_owid_csv. A prediction covers 150 days with two
+    points per day and starts up to max_age days before end_date.
+
+    :return: dictionary (user id, location): prediction
+    """
+    rng = random.Random(seed)
+    if end_date is None:
+        end_date = datetime.date.today() - datetime.timedelta(days=1)
+    end = date2num(end_date)
+    locations = location_names(n_locations)
+
+    predictions = dict()
+    user_id = 100_000_000
+    while len(predictions) < n_predictions:
+        user_id += rng.randint(1, 1000)
+        n_countries = min(rng.randint(1, 5), len(locations), n_predictions - len(predictions))
+        for location in rng.sample(locations, n_countries):
+            start = end - rng.randint(0, max_age) + rng.random()
+            scale = rng.uniform(10, 10_000)
+            slope = rng.uniform(-0.01, 0.01)
+            predictions[user_id, location] = {
+                start + i / 2: max(0.0, scale * (1 + slope * i) * rng.uniform(0.95, 1.05)) for i in range(300)}
+    return predictions
@@ -0,0 +1,124 @@
+import contextlib
+import datetime
+import functools
+import http.server
+import json
+import os
+import platform
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+
+@contextlib.contextmanager
+def local_server(directory: str, handler_class=None):
+    """Serve the files of a directory via HTTP on localhost and yield the base url."""
+    handler = functools.partial(handler_class or QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves files with an ETag and answers conditional (If-None-Match) and range requests (Range, If-Range) like the
+    server of the statistics.
+    """
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+        stat = os.stat(path)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return None
+
+        start = 0
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range", etag) == etag:
+            start = int(match.group(1))
+            if start >= stat.st_size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{stat.st_size - 1}/{stat.st_size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(stat.st_size - start))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.date_time_string(stat.st_mtime))
+        self.end_headers()
+        f = open(path, "rb")
+        f.seek(start)
+        return f
+
+    def log_message(self, *args):
+        pass
+
+
+def timed(func, *args, repeat=1, **kwargs) -> (float, object):
+    """Return the best wall time of several calls in seconds and the result of the last call."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def peak_memory(func, *args, **kwargs) -> (int, object):
+    """Return the peak memory allocated while calling the function (in bytes) and its result."""
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, result
+
+
+def percentiles(samples: list) -> dict:
+    """Summarize latency samples (in seconds) in microseconds."""
+    samples = np.array(samples) * 1e6
+    return {
+        'mean_us': float(np.mean(samples)),
+        'p50_us': float(np.percentile(samples, 50)),
+        'p99_us': float(np.percentile(samples, 99)),
+    }
+
+
+def emit(benchmark: str, params: dict, results: dict, output=None):
+    """Write one benchmark result as a line of JSON, so that results can be collected and compared over time."""
+    record = {
+        'benchmark': benchmark,
+        'timestamp': datetime.datetime.now().isoformat(timespec="seconds"),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'params': params,
+        'results': results,
+    }
+    line = json.dumps(record)
+    if output:
+        with open(output, "a") as f:
+            f.write(line + "\n")
+    else:
+        print(line)
+        sys.stdout.flush()
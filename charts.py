@@ -4,12 +4,13 @@ import os
 
 import numpy as np
 from dateutil.relativedelta import relativedelta
-from matplotlib import pyplot as plt
 from matplotlib.dates import date2num
+from matplotlib.figure import Figure
 from matplotlib.ticker import FixedLocator
 
 import scores
 from constants import N_PREDICTED_DAYS
+from data import DATE_NUM_OFFSET
 
 
 def get_locations(starting_date: datetime.date, ending_date: datetime.date, max_n=5, min_n=3):
@@ -36,13 +37,14 @@ def get_locations(starting_date: datetime.date, ending_date: datetime.date, max_
 
 def visualize(countries: list,
               covid_stats,
-              img_path: str,
+              img_path,
               predictions: list = None,
               titles=None,
               offsets=None,
               mode=None,
               chart_scale=None,
               end_date=None,
+              dpi=None,
               ):
     res = None
 
@@ -68,43 +70,38 @@ def visualize(countries: list,
 
     xs, y_actuals, y_preds, last_actuals = [], [], [], []
     for country, prediction, (beginning_offset, ending_offset) in zip(countries, predictions, offsets):
-        data = covid_stats.get("date", "new_cases_smoothed", location=country)
+        series = covid_stats.get_series(country)
         if prediction is None:
             chart_beginning: np.ndarray = date2num(datetime.datetime.today()) - beginning_offset
-            prediction = tuple()
+            prediction = scores.DailyPrediction(0, np.zeros(0, dtype=np.float32))
         else:
-            prediction = scores.get_daily(prediction)
-            chart_beginning: np.ndarray = list(prediction.keys())[0] - beginning_offset
-        x, y_actual, y_pred = [], [], []
-
-        for str_date, n in data:
-            try:
-                new_cases = float(n)
-                numpy_date = date2num(datetime.date.fromisoformat(str_date))
-                if numpy_date > chart_beginning:
-                    x.append(datetime.date.fromisoformat(str_date))
-                    y_actual.append(new_cases)
-                    y_pred.append(prediction[numpy_date] if numpy_date in prediction else float("nan"))
-            except ValueError:
-                pass
-        for dt_date in (datetime.date.fromisoformat(str_date) + datetime.timedelta(days=i) for i in
-                        range(ending_offset)):
-            if dt_date <= end_date:
-                numpy_date = date2num(dt_date)
-                x.append(dt_date)
-                y_actual.append(float("nan"))
-                y_pred.append(prediction[numpy_date] if numpy_date in prediction else float("nan"))
+            prediction = scores.as_daily(prediction)
+            chart_beginning: np.ndarray = prediction.start - beginning_offset
+
+        shown = ~np.isnan(series.values) & (series.dates > chart_beginning)
+        x = [datetime.date.fromordinal(day) for day in series.ordinals[shown].tolist()]
+        y_actual = series.values[shown].tolist()
+        y_pred = prediction.values_at(series.dates[shown]).tolist()
+
+        last_actual = datetime.date.fromordinal(int(series.ordinals[-1]))
+        future = [last_actual + datetime.timedelta(days=i) for i in range(ending_offset)]
+        future = [dt_date for dt_date in future if dt_date <= end_date]
+        x += future
+        y_actual += [float("nan")] * len(future)
+        y_pred += prediction.values_at([dt_date.toordinal() + DATE_NUM_OFFSET for dt_date in future]).tolist()
         xs.append(x)
         y_actuals.append(y_actual)
         y_preds.append(y_pred)
-        last_actuals.append(datetime.date.fromisoformat(str_date))
+        last_actuals.append(last_actual)
 
     if len(predictions) < 4:
         cols, rows = 1, len(predictions)
     else:
         cols = math.ceil(len(predictions) ** 0.5)
         rows = math.ceil(len(predictions) / cols)
-    fig, axs = plt.subplots(ncols=cols, nrows=rows, figsize=(8 * cols, 4 * rows))
+    # a figure without pyplot does not share any global state, so charts can be rendered in several threads
+    fig = Figure(figsize=(8 * cols, 4 * rows), dpi=dpi)
+    axs = fig.subplots(ncols=cols, nrows=rows)
 
     if len(predictions) == 1:
         axs = [axs]
@@ -115,8 +112,8 @@ def visualize(countries: list,
         ax.plot(x, y_actual, label="reported")
         ax.plot(x, y_pred, label="predicted")
         if mode in ("input", "confirmation"):
-            plt.xlim(right=x[-1])
-            plt.ylim(bottom=0, top=(np.nanmax((np.nanmax(y_actual), np.nanmax(y_pred)))) * chart_scale)
+            ax.set_xlim(right=x[-1])
+            ax.set_ylim(bottom=0, top=(np.nanmax((np.nanmax(y_actual), np.nanmax(y_pred)))) * chart_scale)
         else:
             ax.legend()
         ax.grid(True)
@@ -126,15 +123,19 @@ def visualize(countries: list,
         if mode == "input":
             # drawing area
             assert len(axs) == 1, f"Cannot only generate input for one chart (got {len(axs)})"
-            x0, y0 = ax.transData.transform((date2num(last_actual), plt.ylim()[0]))
-            x1, y1 = ax.transData.transform((plt.xlim()[1], plt.ylim()[1]))
+            x0, y0 = ax.transData.transform((date2num(last_actual), ax.get_ylim()[0]))
+            x1, y1 = ax.transData.transform((ax.get_xlim()[1], ax.get_ylim()[1]))
 
-            x_factor = (plt.xlim()[1] - date2num(last_actual)) / (x1 - x0)
-            y_factor = (plt.ylim()[1] - plt.ylim()[0]) / (y1 - y0)
+            x_factor = (ax.get_xlim()[1] - date2num(last_actual)) / (x1 - x0)
+            y_factor = (ax.get_ylim()[1] - ax.get_ylim()[0]) / (y1 - y0)
             res = x0, y0, x1, y1, x_factor, y_factor
 
-    os.makedirs(os.path.dirname(img_path), exist_ok=True)
-    plt.savefig(img_path)
-    plt.close()
+    if isinstance(img_path, str):
+        os.makedirs(os.path.dirname(img_path), exist_ok=True)
+        fig.savefig(img_path)
+    else:
+        # file objects are rewound, so that the image can be sent or read right away
+        fig.savefig(img_path, format="jpg")
+        img_path.seek(0)
 
     return res
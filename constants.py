@@ -5,8 +5,8 @@
 # Telegram Bot Token (Get a new one from @BotFather)
 TEST_TOKEN = ""
 
-TEMP_PATH = ".temp.jpg"
 DATABASE_PATH = "database.gz"
+HIGH_SCORES_HISTORY_PATH = ".high_scores_history"
 
 
 def is_test_environment():
@@ -26,13 +26,26 @@ ADMIN_USER = 0000000000
 
 TEMP_DIR = ".covid_data"
 CSV_SOURCE = "https://covid.ourworldindata.org/data/owid-covid-data.csv"
-IMAGES_PATH = ".covid_images"
 
 N_PREDICTED_DAYS = 150
 N_DAYS_FOR_PERSISTENCY = 130
 N_DAYS_FOR_DAILY = 10
 
 LINE_THRESHOLD = 0.8
+# number of decoded input charts kept in memory for the line detection
+REFERENCE_CACHE_SIZE = 32
+
+# number of processes used to compute the scores every night (0: compute them in the main process)
+SCORING_WORKERS = 0
+
+# processes that detect drawn lines and render charts for the handlers (0: run them in the handler's thread)
+OFFLOAD_WORKERS = 2
+# unfinished jobs before users are asked to try again later
+OFFLOAD_MAX_PENDING = 8
+# seconds until a job is given up
+OFFLOAD_TIMEOUT = 60
+# jobs after which a worker process is replaced
+OFFLOAD_MAX_TASKS_PER_CHILD = 50
 
 ############################
 # Conversation Structure and Countries
@@ -1,42 +1,511 @@
+import array
+import csv
 import datetime
+import functools
 import glob
+import json
+import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
+import threading
 
+import numpy as np
 import requests
+from matplotlib.dates import date2num
 
 from constants import CSV_SOURCE, TEMP_DIR
 
+DATE_COLUMN = "date"
+LOCATION_COLUMN = "location"
+TEXT_COLUMNS = ("iso_code", "continent", "location", "tests_units")
+# columns parsed when the statistics are loaded, all other columns are parsed on first access
+PRELOADED_COLUMNS = (LOCATION_COLUMN, DATE_COLUMN, "new_cases_smoothed")
+CHUNK_SIZE = 1 << 20
+CACHE_VERSION = 2
 
-class CPGameData(dict):
-    def __init__(self, source: dict):
-        self.last_update = None
+# difference between matplotlib date numbers and day ordinals (depends on the epoch used by matplotlib)
+DATE_NUM_OFFSET = date2num(datetime.date(1970, 1, 1)) - datetime.date(1970, 1, 1).toordinal()
+
+
+def read_validators(path: str) -> dict:
+    """Return the HTTP validators (ETag, Last-Modified) stored next to a downloaded file."""
+    try:
+        with open(f"{path}.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def write_validators(path: str, response: requests.Response):
+    with open(f"{path}.json", "w") as f:
+        json.dump({header: response.headers[header] for header in ("ETag", "Last-Modified")
+                   if header in response.headers}, f)
+
+
+def validate_csv(path: str, required_columns=(LOCATION_COLUMN, DATE_COLUMN, "new_cases_smoothed")):
+    """
+    Check that a downloaded csv file is complete before it is used.
+
+    :raise ValueError: if the header lacks a required column, there are no rows or the last row is truncated
+    """
+    with open(path, "rb") as f:
+        header = f.readline()
+        titles = next(csv.reader([header.decode()]), [])
+        for title in required_columns:
+            if title not in titles:
+                raise ValueError(f"The column '{title}' is missing in {path}.")
+
+        f.seek(0, os.SEEK_END)
+        f.seek(max(len(header), f.tell() - CHUNK_SIZE))
+        tail = f.read()
+    if not tail:
+        raise ValueError(f"There are no rows in {path}.")
+    last_line = tail.rstrip(b"\n").rsplit(b"\n", 1)[-1]
+    if not tail.endswith(b"\n") or len(next(csv.reader([last_line.decode()]))) != len(titles):
+        raise ValueError(f"The last row in {path} is incomplete.")
+
+
+def download(url: str, path: str, previous: str = None) -> bool:
+    """
+    Download a file in chunks without holding the whole body in memory.
+
+    The data is written to a partial file in the same directory, which is validated and renamed to the given path after
+    the download has finished. Therefore, the file at the given path is either complete or does not exist. If a
+    previous download was interrupted, it is resumed with a range request as long as the remote file did not change.
+    A partial file that is complete already (if only the renaming was interrupted) is validated and used.
+
+    :param url: location of the file
+    :param path: destination of the file
+    :param previous: path of an older copy of the file; if it is still up to date, it is moved to the given path
+    :return: True if new data was downloaded, False if the previous copy was reused
+    """
+    part_path = f"{os.path.dirname(path) or '.'}/download.part"
+    headers = dict()
+    if previous:
+        validators = read_validators(previous)
+        if "ETag" in validators:
+            headers['If-None-Match'] = validators['ETag']
+        if "Last-Modified" in validators:
+            headers['If-Modified-Since'] = validators['Last-Modified']
+
+    validators = read_validators(part_path)
+    if os.path.exists(part_path) and validators:
+        headers['Range'] = f"bytes={os.path.getsize(part_path)}-"
+        headers['If-Range'] = validators.get("ETag", validators.get("Last-Modified"))
+        # the offset refers to the bytes of the file, not to a compressed representation of it
+        headers['Accept-Encoding'] = "identity"
+
+    with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 304 and previous:
+            os.replace(previous, path)
+            if os.path.exists(f"{previous}.json"):
+                os.replace(f"{previous}.json", f"{path}.json")
+            return False
+
+        if response.status_code == 416 and "Range" in headers:
+            # there is nothing left to download if the partial file has the size of the remote file
+            if response.headers.get("Content-Range") != f"bytes */{os.path.getsize(part_path)}":
+                remove_part(part_path)
+                return download(url, path, previous)
+        else:
+            response.raise_for_status()
+            if response.status_code == 206 and "Range" in headers and \
+                    response.headers.get("Content-Range", "").startswith(headers['Range'].replace("=", " ")):
+                mode = "ab"
+            else:
+                mode = "wb"
+                write_validators(part_path, response)
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+
+    try:
+        validate_csv(part_path)
+    except ValueError:
+        remove_part(part_path)
+        raise
+    os.replace(f"{part_path}.json", f"{path}.json")
+    os.replace(part_path, path)
+    return True
+
+
+def remove_part(part_path: str):
+    """Delete a partial download and its validators."""
+    for file in (part_path, f"{part_path}.json"):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def parse_csv(lines, columns=PRELOADED_COLUMNS) -> (list, dict, dict):
+    """
+    Parse the OWID csv file into typed columns.
+
+    Dates are stored as day ordinals (int32), text columns as category codes (int32) referring to a tuple of names and
+    all other columns as float64 with NaN for missing values.
+
+    :param lines: iterable yielding the lines of the csv file, starting with the header
+    :param columns: titles of the columns to keep, all other columns are skipped
+    :return: all column titles, a dictionary title: array and a dictionary title: category names
+    """
+    reader = csv.reader(lines)
+    titles = next(reader)
+    kept = [title for title in titles if title in columns]
+    indices = [titles.index(title) for title in kept]
+
+    buffers = []
+    interned = dict()
+    for title in kept:
+        if title == DATE_COLUMN:
+            buffers.append(array.array("i"))
+        elif title in TEXT_COLUMNS:
+            buffers.append(array.array("i"))
+            interned[title] = dict()
+        else:
+            buffers.append(array.array("d"))
+
+    # the dataset contains only a few thousand distinct dates, so they are converted once each
+    ordinals = dict()
+    nan = float("nan")
+
+    for row in reader:
+        if not row:
+            continue
+        for title, index, buffer in zip(kept, indices, buffers):
+            value = row[index] if index < len(row) else ""
+            if title == DATE_COLUMN:
+                try:
+                    buffer.append(ordinals[value])
+                except KeyError:
+                    ordinal = ordinals[value] = datetime.date.fromisoformat(value).toordinal()
+                    buffer.append(ordinal)
+            elif title in interned:
+                codes = interned[title]
+                buffer.append(codes.setdefault(value, len(codes)))
+            else:
+                try:
+                    buffer.append(float(value) if value else nan)
+                except ValueError:
+                    buffer.append(nan)
+
+    columns = dict()
+    for title, buffer in zip(kept, buffers):
+        columns[title] = np.frombuffer(buffer, dtype=np.int32 if buffer.typecode == "i" else np.float64)
+    categories = {title: tuple(codes.keys()) for title, codes in interned.items()}
+    return titles, columns, categories
+
+
+class TimeSeries:
+    """
+    Values of one column for one location.
+
+    :ivar ordinals: day ordinals of the rows
+    :ivar dates: matplotlib date numbers of the rows
+    :ivar values: values of the rows with NaN for missing data
+    """
+
+    def __init__(self, ordinals: np.ndarray, dates: np.ndarray, values: np.ndarray):
+        self.ordinals = ordinals
+        self.dates = dates
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    @functools.cached_property
+    def last_valid_index(self) -> int:
+        """Index of the latest row with a valid value (-1 if there is none)."""
+        valid = np.flatnonzero(~np.isnan(self.values))
+        return int(valid[-1]) if len(valid) else -1
+
+    @property
+    def last_valid(self) -> (float, float):
+        """Date number and value of the latest row with a valid value."""
+        if self.last_valid_index < 0:
+            raise ValueError("There is no valid value in this series.")
+        return float(self.dates[self.last_valid_index]), float(self.values[self.last_valid_index])
+
+
+def load_stats() -> "CovidStats":
+    """
+    Load the latest statistics for Covid-19.
+
+    If no data has been downloaded for the current day, the record is refreshed (only if it changed remotely) and all
+    older files in TEMP_DIR are deleted. If the refresh fails, the most recent older record is used instead.
+    """
+    path = f"{TEMP_DIR}/{datetime.datetime.now().date()}.csv"
+    if not os.path.exists(path):
+        os.makedirs(TEMP_DIR, exist_ok=True)
+        previous = max(glob.glob(f"{TEMP_DIR}/*.csv"), default=None)
+        try:
+            if not download(CSV_SOURCE, path, previous) and os.path.isdir(f"{previous}.cache"):
+                os.replace(f"{previous}.cache", f"{path}.cache")
+        except (requests.RequestException, ValueError) as e:
+            if previous is None:
+                raise
+            logging.error(f"Could not update the statistics, using {previous} instead: {e}")
+            path = previous
+        else:
+            for file in glob.glob(f"{TEMP_DIR}/*.csv*"):
+                if not os.path.basename(file).startswith(os.path.basename(path)):
+                    if os.path.isdir(file):
+                        shutil.rmtree(file, ignore_errors=True)
+                    else:
+                        os.remove(file)
+    return CovidStats(path)
+
+
+def worker_context():
+    """
+    Return the multiprocessing context for worker processes.
+
+    Workers are spawned as fresh processes, forking the bot would copy the locks held by its other threads. Snapshots
+    passed to them are opened again from their cache (see open_snapshot).
+    """
+    return multiprocessing.get_context("spawn")
+
+
+@functools.lru_cache(maxsize=4)
+def open_snapshot(path: str) -> "CovidStats":
+    """Open the statistics of a csv file, reusing the snapshot if it has been opened in this process before."""
+    return CovidStats(path)
+
+
+class CovidStats:
+    """
+    Snapshot of the statistics for Covid-19 read from one csv file.
+
+    The data is never modified after loading, so a snapshot can be read from any thread while a newer one is loaded.
+    Only PRELOADED_COLUMNS are parsed up front, every other column is parsed from the csv file when it is accessed for
+    the first time. The parsed columns are cached in a binary format next to the csv file, so later loads only need to
+    memory-map them. For the same reason, a pickled snapshot only contains the path of its csv file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.last_update = datetime.datetime.now().date()
         self.titles = []
-        self.values = ()
+        self.columns = dict()
+        self.categories = dict()
+        self.locations = dict()
+        self._order = None
+        self._series = dict()
+        self._date_nums = None
+        self._lock = threading.Lock()
 
-        self.update_stats()
-        super().__init__(source)
+        if not self._load_cache(f"{path}.cache"):
+            with open(path, newline="") as f:
+                self.titles, self.columns, self.categories = parse_csv(f)
+            self._build_index()
+            for column in self.columns.values():
+                column.flags.writeable = False
+            self._save_cache(f"{path}.cache")
 
-    def update_stats(self):
+    def __reduce__(self):
+        # other processes open the snapshot from the same csv file, memory-mapping its cache instead of copying it
+        return open_snapshot, (self.path,)
+
+    def column(self, title: str) -> np.ndarray:
         """
-        Load or update the statistics for Covid-19.
+        Return all values of a column, parsing and caching it first if it has not been accessed before.
 
-        If no data has been downloaded for the current day, all csv files in TEMP_DIR are deleted and a new record is
-        downloaded. In any case the values are read from the csv file for the current day.
+        :raise ValueError: if there is no such column
         """
-        path = f"{TEMP_DIR}/{datetime.datetime.now().date()}.csv"
-        if not os.path.exists(path):
-            os.makedirs(TEMP_DIR, exist_ok=True)
-            for file in glob.glob(f"{TEMP_DIR}/*.csv"):
-                os.remove(file)
-            data = requests.get(CSV_SOURCE)
-            with open(path, "w") as f:
-                f.write(data.text)
-        self.last_update = datetime.datetime.now().date()
+        if title in self.columns:
+            return self.columns[title]
+        if title not in self.titles:
+            raise ValueError(f"'{title}' is not a valid column.")
+
+        with self._lock:
+            if title not in self.columns:
+                directory = f"{self.path}.cache"
+                try:
+                    column = np.load(f"{directory}/{title}.npy", mmap_mode="r")
+                    with open(f"{directory}/{title}.json") as f:
+                        categories = json.load(f)
+                except (OSError, ValueError):
+                    column, categories = self._parse_column(title)
+                    self._save_column(directory, title, column, categories)
+                if categories is not None:
+                    self.categories[title] = tuple(categories)
+                self.columns[title] = column
+        return self.columns[title]
 
-        with open(path) as f:
-            lines = f.readlines()
-        self.titles = lines[0][:-1].split(",")
-        self.values = tuple(line[:-1].split(",")[:7] for line in lines[1:])  # discard right part of the table
+    def _parse_column(self, title: str) -> (np.ndarray, tuple):
+        """Parse a single column from the csv file and bring it into the order of the other columns."""
+        logging.info(f"Parsing column '{title}' from {self.path}.")
+        try:
+            with open(self.path, newline="") as f:
+                _, columns, categories = parse_csv(f, (title,))
+        except OSError as e:
+            raise ValueError(f"The column '{title}' cannot be loaded anymore: {e}")
+        column = columns[title]
+        if self._order is not None:
+            column = column[self._order]
+        column.flags.writeable = False
+        return column, categories.get(title)
+
+    @staticmethod
+    def _save_column(directory: str, title: str, column: np.ndarray, categories: tuple):
+        """
+        Add a lazily parsed column to the cache directory.
+
+        Several processes may parse the same column, so every writer uses its own temporary files.
+        """
+        try:
+            fd, categories_path = tempfile.mkstemp(dir=directory, prefix=f"{title}.", suffix=".part.json")
+            with os.fdopen(fd, "w") as f:
+                json.dump(categories, f)
+            fd, column_path = tempfile.mkstemp(dir=directory, prefix=f"{title}.", suffix=".part.npy")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, column)
+            os.replace(categories_path, f"{directory}/{title}.json")
+            os.replace(column_path, f"{directory}/{title}.npy")
+        except OSError as e:
+            logging.error(f"Could not cache the column '{title}' at {directory}: {e}")
+
+    def _load_cache(self, directory: str) -> bool:
+        """
+        Memory-map the parsed columns from a cache directory created by _save_cache.
+
+        :return: False if there is no usable cache
+        """
+        try:
+            with open(f"{directory}/index.json") as f:
+                index = json.load(f)
+            if index['version'] != CACHE_VERSION:
+                return False
+            columns = {title: np.load(f"{directory}/{title}.npy", mmap_mode="r") for title in index['columns']}
+            order = np.load(f"{directory}/order.npy", mmap_mode="r") if index['sorted'] else None
+        except (OSError, ValueError, KeyError):
+            return False
+
+        self.titles = index['titles']
+        self.columns = columns
+        self.categories = {title: tuple(names) for title, names in index['categories'].items()}
+        self.locations = {location: tuple(rows) for location, rows in index['locations'].items()}
+        self._order = order
+        return True
+
+    def _save_cache(self, directory: str):
+        """
+        Store the parsed columns as .npy files, so that other processes and later starts can memory-map them.
+
+        The files are written to a temporary directory first, which is renamed when it is complete. An unusable cache
+        (of another CACHE_VERSION or with missing files) is moved aside and replaced. The names of the temporary
+        directories start with the one of the cache, so that load_stats deletes them with the other files of the day if
+        they are left behind.
+        """
+        temp_directory = tempfile.mkdtemp(dir=os.path.dirname(directory) or ".",
+                                          prefix=f"{os.path.basename(directory)}.", suffix=".part")
+        try:
+            for title, column in self.columns.items():
+                np.save(f"{temp_directory}/{title}.npy", column)
+            if self._order is not None:
+                np.save(f"{temp_directory}/order.npy", self._order)
+            with open(f"{temp_directory}/index.json", "w") as f:
+                json.dump({
+                    'version': CACHE_VERSION,
+                    'titles': self.titles,
+                    'columns': list(self.columns.keys()),
+                    'categories': self.categories,
+                    'locations': self.locations,
+                    'sorted': self._order is not None,
+                }, f)
+            try:
+                os.rename(temp_directory, directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+                stale_directory = tempfile.mkdtemp(dir=os.path.dirname(directory) or ".",
+                                                   prefix=f"{os.path.basename(directory)}.", suffix=".stale")
+                os.rename(directory, stale_directory)
+                os.rename(temp_directory, directory)
+                shutil.rmtree(stale_directory, ignore_errors=True)
+        except OSError as e:
+            logging.error(f"Could not cache the statistics at {directory}: {e}")
+            shutil.rmtree(temp_directory, ignore_errors=True)
+
+    def _build_index(self):
+        """
+        Sort the rows by location and date (if necessary) and store the range of rows belonging to each location.
+
+        The OWID dataset is grouped by location already, so usually this only needs a single pass over the codes.
+        """
+        codes, dates = self.columns[LOCATION_COLUMN], self.columns[DATE_COLUMN]
+        key = (codes.astype(np.int64) << 32) | (dates.astype(np.int64) & 0xFFFFFFFF)
+        if len(key) and np.any(key[1:] < key[:-1]):
+            self._order = order = np.argsort(key, kind="stable")
+            self.columns = {title: column[order] for title, column in self.columns.items()}
+            codes = self.columns[LOCATION_COLUMN]
+
+        boundaries = [0, *(np.flatnonzero(codes[1:] != codes[:-1]) + 1), len(codes)]
+        names = self.categories[LOCATION_COLUMN]
+        self.locations = {names[codes[start]]: (int(start), int(stop))
+                          for start, stop in zip(boundaries[:-1], boundaries[1:])}
+
+    def find_row(self, location: str, date) -> int:
+        """
+        Return the index of the row for a certain location and date or None if there is no such row.
+
+        :param location: name of the location
+        :param date: datetime.date or ISO formatted string
+        """
+        if location not in self.locations:
+            return None
+        if isinstance(date, str):
+            date = datetime.date.fromisoformat(date)
+        start, stop = self.locations[location]
+        ordinal = date.toordinal()
+        row = start + int(np.searchsorted(self.columns[DATE_COLUMN][start:stop], ordinal))
+        if row < stop and self.columns[DATE_COLUMN][row] == ordinal:
+            return row
+        return None
+
+    def get_series(self, location: str, column: str = "new_cases_smoothed") -> TimeSeries:
+        """
+        Return the values of a numeric column for one location.
+
+        The arrays are views of the dataset and the series is cached for the lifetime of the snapshot.
+        """
+        key = location, column
+        if key not in self._series:
+            values = self.column(column)
+            if column == DATE_COLUMN or column in self.categories:
+                raise ValueError(f"'{column}' is not a numeric column.")
+            if self._date_nums is None:
+                self._date_nums = self.columns[DATE_COLUMN] + DATE_NUM_OFFSET
+            rows = slice(*self.locations.get(location, (0, 0)))
+            self._series[key] = TimeSeries(self.columns[DATE_COLUMN][rows], self._date_nums[rows], values[rows])
+        return self._series[key]
+
+    def _format(self, title: str, values: np.ndarray) -> list:
+        """Convert the values of a column back into the strings used in the csv file."""
+        if title == DATE_COLUMN:
+            return [datetime.date.fromordinal(int(value)).isoformat() for value in values]
+        if title in self.categories:
+            names = self.categories[title]
+            return [names[value] for value in values]
+        out = []
+        for value in values:
+            if np.isnan(value):
+                out.append("")
+            else:
+                text = repr(float(value))
+                out.append(text[:-2] if text.endswith(".0") else text)
+        return out
+
+    def _match(self, title: str, column: np.ndarray, value: str) -> np.ndarray:
+        """Return a boolean mask of all values in the column that equal the string representation of the value."""
+        try:
+            if title == DATE_COLUMN:
+                return column == datetime.date.fromisoformat(value).toordinal()
+            if title in self.categories:
+                return column == self.categories[title].index(value)
+            return column == float(value)
+        except ValueError:
+            return np.zeros(len(column), dtype=bool)
 
     def get(self, *titles, **filters) -> list:
         """
@@ -53,18 +522,51 @@ class CPGameData(dict):
         for filter_title in filters.keys():
             if filter_title not in self.titles:
                 raise ValueError(f"'{filter_title}' is not a valid filter.")
+        columns = {title: self.column(title) for title in (*titles, *filters.keys())}
 
-        res = []
-        res_indices = [self.titles.index(arg) for arg in titles]
+        filters = {title: str(value) for title, value in filters.items()}
+        if LOCATION_COLUMN in filters:
+            location = filters.pop(LOCATION_COLUMN)
+            if DATE_COLUMN in filters:
+                try:
+                    row = self.find_row(location, filters.pop(DATE_COLUMN))
+                except ValueError:
+                    row = None
+                rows = np.array([] if row is None else [row], dtype=np.int64)
+            else:
+                rows = np.arange(*self.locations.get(location, (0, 0)))
+        else:
+            rows = np.arange(len(self.columns[DATE_COLUMN]))
 
-        def filter_row(values):
-            return [values[i] for i in res_indices]
+        for title, value in filters.items():
+            rows = rows[self._match(title, columns[title][rows], value)]
 
-        for row in self.values:
-            for title, value in zip(self.titles, row):
-                if title in filters.keys() and value != str(filters[title]):
-                    break
-            else:
-                res.append(filter_row(row))
+        res_columns = [self._format(title, columns[title][rows]) for title in titles]
+        return [list(row) for row in zip(*res_columns)] if titles else [[] for _ in rows]
+
+
+class CPGameData(dict):
+    """
+    The database of the bot, which also provides the latest statistics for Covid-19.
+
+    The statistics are held in an immutable CovidStats snapshot. Updating them loads a new snapshot and replaces the
+    reference in one step, so readers that keep a reference to self.stats never see a partially updated dataset.
+    """
+
+    def __init__(self, source: dict):
+        self.stats = load_stats()
+        super().__init__(source)
+
+    @property
+    def last_update(self) -> datetime.date:
+        return self.stats.last_update
+
+    def update_stats(self):
+        """Load or update the statistics for Covid-19 and publish them once they are loaded completely."""
+        self.stats = load_stats()
+
+    def get(self, *titles, **filters) -> list:
+        return self.stats.get(*titles, **filters)
 
-        return res
+    def get_series(self, location: str, column: str = "new_cases_smoothed") -> TimeSeries:
+        return self.stats.get_series(location, column)
@@ -0,0 +1,231 @@
+import bisect
+import datetime
+import os
+
+import numpy as np
+
+from constants import SUPPORTED_COUNTRIES
+
+
+class Leaderboard:
+    """
+    High score list that stays sorted from the highest to the lowest score while entries are set or removed.
+
+    Every entry (score, user id, country) is stored under a key, usually (user id, country). Entries with the same score
+    are ranked in the order in which they were set, just like after a stable sort of a list. Looking up the rank of a
+    key takes O(log n); setting or removing an entry additionally moves the entries behind it in two flat lists.
+
+    The leaderboard can be iterated, indexed and sliced like the list of entries it replaces.
+    """
+
+    def __init__(self, items=()):
+        """
+        :param items: iterable of (key, entry) in the order in which they were set
+        """
+        latest = dict()
+        for key, entry in items:
+            latest.pop(key, None)
+            latest[key] = tuple(entry)
+        positions = sorted(((-entry[0], sequence), key, entry)
+                           for sequence, (key, entry) in enumerate(latest.items()))
+
+        self._order = [sort_key for sort_key, _, _ in positions]  # (-score, sequence number) of every position
+        self._entries = [entry for _, _, entry in positions]  # (score, user id, country) of every position
+        self._index = {key: sort_key for sort_key, key, _ in positions}
+        self._users = dict()  # user id: set of keys
+        for _, key, entry in positions:
+            self._users.setdefault(entry[1], set()).add(key)
+        self._sequence = len(positions)
+        self.version = 0  # incremented on every change
+
+    @classmethod
+    def from_entries(cls, entries) -> "Leaderboard":
+        """
+        Create a leaderboard from a list of (score, user id, country) as stored by previous versions.
+
+        Further entries for the same user and country (e.g. persistent scores) get the keys (user id, country, n).
+        """
+        items = []
+        counts = dict()
+        for entry in entries:
+            key = entry[1], entry[2]
+            counts[key] = counts.get(key, 0) + 1
+            items.append((key if counts[key] == 1 else (*key, counts[key] - 1), tuple(entry)))
+        return cls(items)
+
+    def set(self, key, entry: tuple):
+        """Store the entry (score, user id, country) for the key, replacing the previous entry of the key."""
+        self._discard(key)
+        sort_key = -entry[0], self._sequence
+        self._sequence += 1
+        position = bisect.bisect_left(self._order, sort_key)
+        self._order.insert(position, sort_key)
+        self._entries.insert(position, tuple(entry))
+        self._index[key] = sort_key
+        self._users.setdefault(entry[1], set()).add(key)
+        self.version += 1
+
+    def discard(self, key):
+        """Remove the entry of the key if there is one."""
+        if self._discard(key):
+            self.version += 1
+
+    def _discard(self, key) -> bool:
+        if key not in self._index:
+            return False
+        position = bisect.bisect_left(self._order, self._index.pop(key))
+        user_id = self._entries[position][1]
+        del self._order[position]
+        del self._entries[position]
+        self._users[user_id].discard(key)
+        if not self._users[user_id]:
+            del self._users[user_id]
+        return True
+
+    def rank(self, key) -> int:
+        """
+        Return the rank of the key, starting at 1.
+
+        :raise KeyError: if there is no entry for the key
+        """
+        return bisect.bisect_left(self._order, self._index[key]) + 1
+
+    def ranks_of_user(self, user_id) -> list:
+        """Return (rank, entry) of all entries of a user, sorted by their rank."""
+        ranks = sorted(self.rank(key) for key in self._users.get(user_id, ()))
+        return [(rank, self._entries[rank - 1]) for rank in ranks]
+
+    def __contains__(self, key) -> bool:
+        return key in self._index
+
+    def __getitem__(self, item):
+        return self._entries[item]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __getstate__(self) -> dict:
+        # only the keys and entries in their order are pickled, the index is rebuilt when loading
+        keys = sorted(self._index, key=self._index.get)
+        return {'items': list(zip(keys, self._entries)), 'version': self.version}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state['items'])
+        self.version = state['version']
+
+
+# compact country codes used by the snapshots, -1 for unknown countries
+COUNTRY_CODES = {label[3:]: code for code, label in enumerate(SUPPORTED_COUNTRIES)}
+SNAPSHOT_COLUMNS = {'scores': np.float32, 'users': np.int64, 'countries': np.int16}
+SNAPSHOT_INDEX = np.dtype([('date', np.int64), ('start', np.int64), ('stop', np.int64)])
+
+
+def country_of(code: int) -> str:
+    """Return the name of the country with the given code."""
+    return SUPPORTED_COUNTRIES[code][3:] if code >= 0 else ""
+
+
+class SnapshotArchive:
+    """
+    Append-only archive with one snapshot of a high scores view per day.
+
+    The rows of a snapshot (sorted by rank) are appended to one file per column (score float32, user id int64, country
+    code int16), then an entry (date ordinal, first row, end of rows) is appended to the index file. Queries
+    memory-map the columns and only read the rows of the requested day. Rows behind the last index entry belong to an
+    interrupted append and are overwritten by the next one.
+    """
+
+    def __init__(self, directory: str, view: str):
+        self.directory = directory
+        self.view = view
+
+    def _path(self, column: str) -> str:
+        return f"{self.directory}/{self.view}.{column}.bin"
+
+    def _index(self) -> np.ndarray:
+        try:
+            with open(self._path("index"), "rb") as f:
+                index = f.read()
+        except FileNotFoundError:
+            return np.zeros(0, dtype=SNAPSHOT_INDEX)
+        return np.frombuffer(index, dtype=SNAPSHOT_INDEX, count=len(index) // SNAPSHOT_INDEX.itemsize)
+
+    def _column(self, column: str, start: int, stop: int) -> np.ndarray:
+        dtype = np.dtype(SNAPSHOT_COLUMNS[column])
+        if start == stop:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._path(column), dtype=dtype, mode="r", offset=start * dtype.itemsize, shape=(stop - start,))
+
+    def _rows(self, date: datetime.date) -> (int, int):
+        index = self._index()
+        matches = np.flatnonzero(index['date'] == date.toordinal())
+        if not len(matches):
+            raise KeyError(f"There is no {self.view} high scores snapshot for {date}.")
+        entry = index[matches[-1]]
+        return int(entry['start']), int(entry['stop'])
+
+    def dates(self) -> list:
+        """Return the dates of all snapshots."""
+        return [datetime.date.fromordinal(int(ordinal)) for ordinal in self._index()['date']]
+
+    def append(self, date: datetime.date, entries):
+        """
+        Store the entries (score, user id, country) of a day in their order, unless there already is a snapshot for
+        that day or a later one.
+        """
+        index = self._index()
+        if len(index) and index['date'][-1] >= date.toordinal():
+            return
+        start = int(index['stop'][-1]) if len(index) else 0
+
+        entries = list(entries)
+        columns = {
+            'scores': [entry[0] for entry in entries],
+            'users': [entry[1] for entry in entries],
+            'countries': [COUNTRY_CODES.get(entry[2], -1) for entry in entries],
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        for column, values in columns.items():
+            with open(self._path(column), "ab") as f:
+                f.truncate(start * np.dtype(SNAPSHOT_COLUMNS[column]).itemsize)
+                np.array(values, dtype=SNAPSHOT_COLUMNS[column]).tofile(f)
+        with open(self._path("index"), "ab") as f:
+            f.truncate(len(index) * SNAPSHOT_INDEX.itemsize)
+            np.array([(date.toordinal(), start, start + len(entries))], dtype=SNAPSHOT_INDEX).tofile(f)
+
+    def top(self, date: datetime.date, n=10) -> list:
+        """
+        Return the first n entries (score, user id, country) of the snapshot of a day.
+
+        :raise KeyError: if there is no snapshot for that day
+        """
+        start, stop = self._rows(date)
+        stop = min(stop, start + n)
+        scores, users, codes = (self._column(column, start, stop).tolist() for column in SNAPSHOT_COLUMNS)
+        return [(score, user_id, country_of(code)) for score, user_id, code in zip(scores, users, codes)]
+
+    def ranks_of_user(self, date: datetime.date, user_id: int) -> list:
+        """
+        Return (rank, score, country) of all entries of a user in the snapshot of a day, sorted by their rank.
+
+        :raise KeyError: if there is no snapshot for that day
+        """
+        start, stop = self._rows(date)
+        rows = np.flatnonzero(self._column("users", start, stop) == user_id)
+        scores = self._column("scores", start, stop)[rows].tolist()
+        codes = self._column("countries", start, stop)[rows].tolist()
+        return [(int(row) + 1, score, country_of(code)) for row, score, code in zip(rows, scores, codes)]
+
+    def rank_on(self, date: datetime.date, user_id: int, country: str):
+        """
+        Return the rank of a user's prediction for a country on a day, or None if it was not listed.
+
+        :raise KeyError: if there is no snapshot for that day
+        """
+        start, stop = self._rows(date)
+        rows = np.flatnonzero((self._column("users", start, stop) == user_id) &
+                              (self._column("countries", start, stop) == COUNTRY_CODES.get(country, -1)))
+        return int(rows[0]) + 1 if len(rows) else None
@@ -1,5 +1,8 @@
 import datetime
 import logging
+import threading
+from collections import OrderedDict
+
 import numpy as np
 from PIL import Image
 from matplotlib.dates import date2num
@@ -7,90 +10,121 @@ from matplotlib.dates import date2num
 import charts
 import constants
 from constants import LINE_THRESHOLD
-from data import CPGameData
+from data import CovidStats
+
+
+# decoded input charts (see image_data) by reference_key, the least recently used one first
+_references = OrderedDict()
+_references_lock = threading.Lock()
+
+
+def reference_key(country: str, chart_scale: float, covid_stats: CovidStats) -> tuple:
+    """Identify an input chart by the parameters and the data it is rendered from."""
+    return country, chart_scale, covid_stats.path, datetime.date.today()
+
+
+def decode_reference(image_file) -> np.ndarray:
+    """Decode a rendered input chart (path or file object) like the drawings it is compared with."""
+    with Image.open(image_file) as image:
+        return image_data(image, (0, 0, *image.size))
+
+
+def store_reference(key: tuple, reference: np.ndarray) -> np.ndarray:
+    """Keep a decoded input chart in memory, dropping the least recently used."""
+    with _references_lock:
+        _references[key] = reference
+        _references.move_to_end(key)
+        while len(_references) > constants.REFERENCE_CACHE_SIZE:
+            _references.popitem(last=False)
+    return reference
+
 
+def get_reference(key: tuple):
+    """Return the decoded input chart of the key or None if it is not cached."""
+    with _references_lock:
+        if key not in _references:
+            return None
+        _references.move_to_end(key)
+        return _references[key]
 
-def evaluate(prediction_path: str, country: str, drawing_area: tuple, covid_stats: CPGameData) -> dict:
+
+def image_data(image: Image.Image, box: tuple) -> np.ndarray:
+    """
+    Return the sum of the color channels of every pixel inside a box (x0, y0, x1, y1) of the image.
+
+    The pixels are copied straight from the decoded image into a small integer array.
+    """
+    if box[2] <= box[0] or box[3] <= box[1]:
+        return np.zeros((max(box[3] - box[1], 0), max(box[2] - box[0], 0)), dtype=np.int16)
+    pixels = np.asarray(image.crop(box))
+    return pixels.sum(axis=2, dtype=np.int16) if pixels.ndim == 3 else pixels.astype(np.int16)
+
+
+def evaluate(prediction_file, country: str, drawing_area: tuple, covid_stats: CovidStats,
+             reference: np.ndarray) -> dict:
     """
     Detect a line and convert it into numerical values.
-    :param prediction_path: path containing an image with the drawn line
+    :param prediction_file: path or file object containing an image with the drawn line
     :param country: predicted country
     :param drawing_area: postition and scaling of the relevant area in the prediction image in the format (x0, y0, x1, y1, x_factor, y_factor)
     :param covid_stats: Covid-19-statistics
+    :param reference: decoded input chart the line was drawn on (see decode_reference)
     :return: dictionary in the format date: prediction
     """
-    pred_image = Image.open(prediction_path)
-    country_image = Image.open(f"{constants.IMAGES_PATH}/{country}.jpg")
-    if not pred_image.size == country_image.size:
+    pred_image = Image.open(prediction_file)
+    if not pred_image.size == (reference.shape[1], reference.shape[0]):
         logging.error("The size of the submitted image is not equal to the original size.")
         return "The size of the submitted image is not equal to the original size. Please try again."
 
-    size = pred_image.size[1], pred_image.size[0]
-    pred_data = np.sum(np.array(pred_image.getdata()), axis=1).reshape(size)
-    country_data = np.sum(np.array(country_image.getdata()), axis=1).reshape(size)
+    # only decode the drawing area, summing up the color channels
+    x0, y0, x1, y1, x_factor, y_factor = drawing_area
+    box = int(x0), int(y0), min(int(x1), pred_image.size[0]), min(int(y1), pred_image.size[1])
+    pred_data = image_data(pred_image, box)
+    country_data = reference[box[1]:box[3], box[0]:box[2]]
 
     # calculate the difference between original chart and prediction
-    x0, y0, x1, y1, x_factor, y_factor = drawing_area
-    diff = np.abs(pred_data - country_data).T[int(x0):int(x1), int(y0):int(y1)]
+    diff = np.abs(pred_data - country_data).T
     x_offset = x0 % 1
     y_offset = y0 % 1
 
-    line_pixels = []
-    for column in diff:
-        if np.max(column) < 150:
-            # ignore noise
-            line_pixels.append(np.array([]))
-        else:
-            # store all pixels with a significant difference
-            line_pixels.append(np.argwhere(column >= np.max(column) * LINE_THRESHOLD))
-
-    for i in line_pixels:
-        if len(i):
-            break
-    else:
+    # store all pixels with a significant difference, ignore noise
+    column_max = diff.max(axis=1, initial=0)
+    significant = (diff >= column_max[:, np.newaxis] * LINE_THRESHOLD) & (column_max >= 150)[:, np.newaxis]
+    n_significant = np.count_nonzero(significant, axis=1)
+    if not n_significant.any():
         logging.error("No line was found.")
         return "No line was found. Please try again."
 
     # estimate the line thickness
-    thicknesses = []
-    for column in line_pixels:
-        if len(column) > 1:
-            thicknesses.append(max(column) - min(column))
-    line_thickness = np.quantile(thicknesses, 0.2)
-
-    line = []
-    for column in line_pixels:
-        if not len(column):
-            line.append(float("nan"))
-        else:
-            # In case the user is drawing two lines above each other, taking the mean of the y values is not sufficient.
-            # Therefore, take the lowest value of the column and add half of the typical thickness.
-            line.append(np.min(column) + line_thickness / 2)
-
-    data = covid_stats.get("date", "new_cases_smoothed", location=country)
+    top = significant.argmax(axis=1)
+    bottom = significant.shape[1] - 1 - significant[:, ::-1].argmax(axis=1)
+    thicknesses = (bottom - top)[n_significant > 1]
+    line_thickness = np.quantile(thicknesses, 0.2) if len(thicknesses) else 0
+
+    # In case the user is drawing two lines above each other, taking the mean of the y values is not sufficient.
+    # Therefore, take the lowest value of the column and add half of the typical thickness.
+    line = np.where(n_significant > 0, top + line_thickness / 2, np.nan)
+
+    series = covid_stats.get_series(country)
 
     # find the latest readable case statistics
-    for i in range(1, 4):
-        try:
-            last_date, last_value = date2num(datetime.date.fromisoformat(data[-i][0])), float(data[-i][1])
-            break
-        except ValueError:
-            logging.error(f"No data for {country} available (attempt {i}).")
-    else:
+    if series.last_valid_index < len(series) - 3:
         raise ValueError(f"There is no readable data for {country}.")
+    if series.last_valid_index < len(series) - 1:
+        logging.error(f"No data for {country} available for the last "
+                      f"{len(series) - 1 - series.last_valid_index} day(s).")
+    last_date, last_value = series.last_valid
 
     # map predicted values with their date and scale them according to the chart
     predictions = dict()
     predictions[date2num(datetime.date.today())] = last_value
-    last = None
-    for i, point in enumerate(line):
-        if not np.isnan(point):
-            cases = (y1 - y0 - y_offset - point) * y_factor
-            if cases < 0: cases = 0
-            last = predictions[date2num(datetime.date.today()) +
-                                   (x_offset + i) * x_factor] = cases
-    if not line or last is None:
+    columns = np.flatnonzero(~np.isnan(line))
+    if not len(columns):
         return "No line was found. Please try again."
+    dates = date2num(datetime.date.today()) + (x_offset + columns) * x_factor
+    cases = np.maximum((y1 - y0 - y_offset - line[columns]) * y_factor, 0)
+    predictions.update(zip(dates.tolist(), cases.tolist()))
+    last = cases[-1].item()
 
     # map the last prediction with the last date in case the line did not fill the whole chart horizontally
     predictions[date2num(datetime.date.today() + datetime.timedelta(days=charts.N_PREDICTED_DAYS))] = last
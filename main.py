@@ -1,4 +1,5 @@
 import datetime
+import io
 import logging
 import os
 import random
@@ -19,8 +20,11 @@ from telegram.utils.helpers import escape_markdown, mention_markdown
 import charts
 import constants
 import line_detection
+import offload
 from data import CPGameData
-from scores import get_score, get_daily
+from leaderboard import Leaderboard, SnapshotArchive
+from offload import Offload, PoolBusy, JobTimeout
+from scores import interpolate, as_daily, score_all, ScoreState
 
 
 def load_database(base: CPGameData):
@@ -51,6 +55,7 @@ def backup_database(*args):
     logging.info(f"Backed up database at {constants.DATABASE_PATH}.")
     if args:
         updater.stop()
+        offload_pool.close()
 
 
 def mention_from_id(user_id):
@@ -171,6 +176,7 @@ def start(update, context, start_message=True):
         database['users'][user_id] = {
             'chart_scale': 1.5,
             'drawing_area': None,  # type: tuple
+            'drawing_reference': None,  # type: tuple
             'drawing_update': None,  # type: datetime.date
             'high_scores_view': "yesterday",  # type: str
             'last_conversation_state': constants.MENU,  # type: int
@@ -187,6 +193,7 @@ def start(update, context, start_message=True):
             'scores': dict(),
             'scores_daily': dict(),
             'scores_persistent': dict(),
+            'score_states': dict(),
             'update_notifications': True,
         }
     else:
@@ -214,13 +221,47 @@ def select_country(update, _):
     return constants.GIVE_PREDICTION
 
 
-def prediction_caption(user_data):
+def busy(reply_text):
+    reply_text("⏳ Sorry, there is a lot going on right now. Please try it again in a minute.")
+
+
+def job_failed(reply_text, retry: str):
+    """Return an error callback for offloaded jobs that tells the user what to do."""
+
+    def error_callback(e):
+        if isinstance(e, JobTimeout):
+            logging.warning(e)
+            reply_text(f"⏳ Oh no, this took too long. {retry}")
+        else:
+            logging.error("offloaded job failed", exc_info=e)
+            reply_text(f"Oh no, something went wrong. {retry}")
+
+    return error_callback
+
+
+def send_prediction_chart(user_data, reply, reply_text):
+    """
+    Render the chart for the recent country in a worker and pass it to reply(photo, caption, reply_markup).
+
+    :raise PoolBusy: if the chart can not be rendered right now
+    """
     country = user_data['recent_country']
-    res = charts.visualize([country], database, img_path=f"{constants.IMAGES_PATH}/{country}.jpg", mode="input",
-                           chart_scale=user_data['chart_scale'])
-    if res:
-        user_data['drawing_area'] = res
-        user_data['drawing_update'] = datetime.date.today()
+    stats = database.stats
+    chart_scale = user_data['chart_scale']
+
+    def rendered(result):
+        if user_data['recent_country'] != country or user_data['chart_scale'] != chart_scale:
+            # the user selected another country or zoomed while the chart was rendered, a newer chart follows
+            return
+        chart, res, reference = result
+        if res:
+            # keep the chart the user receives to compare the drawing with it
+            key = line_detection.reference_key(country, chart_scale, stats)
+            line_detection.store_reference(key, reference)
+            user_data['drawing_area'] = res
+            user_data['drawing_reference'] = key
+            user_data['drawing_update'] = datetime.date.today()
+        reply(io.BytesIO(chart), caption, reply_markup)
 
     if country in user_data['predictions'].keys():
         if country in user_data['persistency_notification_sent']:
@@ -248,7 +289,8 @@ def prediction_caption(user_data):
         InlineKeyboardButton("🔍 zoom in", callback_data="user|scale|dec"),
         InlineKeyboardButton("🔄 reset zoom", callback_data="user|scale|reset")
     ])
-    return caption, reply_markup
+    offload_pool.submit(offload.render_input_chart, (country, stats, chart_scale), callback=rendered,
+                        error_callback=job_failed(reply_text, "Please select the country again."))
 
 
 def give_prediction(update, _):
@@ -274,14 +316,17 @@ def give_prediction(update, _):
     # noinspection PyTypeChecker
     updater.bot.send_chat_action(user_id, ChatAction.UPLOAD_PHOTO)
     user_data['recent_country'] = country
-    caption, reply_markup = prediction_caption(user_data)
-
-    with open(f"{constants.IMAGES_PATH}/{country}.jpg", "rb") as f:
-        update.message.reply_photo(
-            photo=f,
-            caption=caption,
-            reply_markup=reply_markup,
-        )
+    try:
+        send_prediction_chart(user_data,
+                              lambda photo, caption, reply_markup: update.message.reply_photo(
+                                  photo=photo,
+                                  caption=caption,
+                                  reply_markup=reply_markup,
+                              ),
+                              update.message.reply_text)
+    except PoolBusy:
+        busy(update.message.reply_text)
+        return constants.GIVE_PREDICTION
     return constants.CONFIRM_PREDICTION
 
 
@@ -290,33 +335,56 @@ def confirm_prediction(update, _):
     user_id = update.message.from_user.id
     # noinspection PyTypeChecker
     updater.bot.send_chat_action(user_id, ChatAction.UPLOAD_PHOTO)
-    country = database['users'][user_id]['recent_country']
-    drawing_area = database['users'][user_id]['drawing_area']
+    user_data = database['users'][user_id]
+    country = user_data['recent_country']
+    drawing_area = user_data['drawing_area']
+
+    stats = database.stats
+
+    # compare with the chart the user drew on, it can be rendered again as long as the data is the same
+    key = user_data['drawing_reference']
+    chart_scale = user_data['chart_scale']
+    if key is None or key[0] != country:
+        # the chart of the country has not been sent yet
+        update.message.reply_text(f"📈 Please wait for the chart of {country} and draw your prediction on it.")
+        return constants.CONFIRM_PREDICTION
+    reference = line_detection.get_reference(key)
+    if reference is None and key != line_detection.reference_key(country, chart_scale, stats):
+        update.message.reply_text("📈 The statistics have been updated since you got this chart. Please select the "
+                                  "country again and draw your prediction on the new chart.")
+        return constants.CONFIRM_PREDICTION
 
     file = update.message.photo[-1].get_file()
+    photo = io.BytesIO()
+    file.download(out=photo)
 
-    temp_lock.acquire()
-    try:
-        file.download(custom_path=constants.TEMP_PATH)
-        raw_predictions = line_detection.evaluate(constants.TEMP_PATH, country, drawing_area, database)
+    def detected(result):
+        raw_predictions, confirmation, rendered = result
+        if rendered is not None:
+            line_detection.store_reference(key, rendered)
         if type(raw_predictions) == str:
             update.message.reply_text(raw_predictions)
-            return constants.CONFIRM_PREDICTION
-        database['users'][user_id]['recent_prediction'] = raw_predictions
-        charts.visualize([country], database, constants.TEMP_PATH, [raw_predictions], mode="confirmation",
-                         chart_scale=database['users'][user_id]['chart_scale'])
-        with open(constants.TEMP_PATH, "rb") as f:
-            update.message.reply_photo(
-                photo=f,
-                caption="This is how your line is detected. Is everything okay here?",
-                reply_markup=ReplyKeyboardMarkup(
-                    [["✅ Seems right, continue"], ["⏪ No, go back"]],
-                    one_time_keyboard=True
-                )
+            return
+        user_data['recent_prediction'] = raw_predictions
+        user_data['last_conversation_state'] = constants.LINK_ACCOUNT
+        update.message.reply_photo(
+            photo=io.BytesIO(confirmation),
+            caption="This is how your line is detected. Is everything okay here?",
+            reply_markup=ReplyKeyboardMarkup(
+                [["✅ Seems right, continue"], ["⏪ No, go back"]],
+                one_time_keyboard=True
             )
-    finally:
-        temp_lock.release()
-    return constants.LINK_ACCOUNT
+        )
+
+    try:
+        offload_pool.submit(offload.detect_line,
+                            (photo.getvalue(), country, drawing_area, stats, reference, chart_scale),
+                            callback=detected,
+                            error_callback=job_failed(update.message.reply_text, "Please send your drawing again."))
+    except PoolBusy:
+        busy(update.message.reply_text)
+    # the conversation continues when the line is detected
+    return None
 
 
 def link_account(update, _):
@@ -340,10 +408,11 @@ def link_account(update, _):
                 user_data['scores_persistent'][country] = user_data['scores'][country]
 
         # save prediction
-        user_data['predictions'][country] = user_data['recent_prediction']
+        user_data['predictions'][country] = interpolate(user_data['recent_prediction'])
         user_data['scores'][country] = 0
-        database['high_scores'].append((0, user_id, country))
-        database['high_scores_daily'].append((0, user_id, country))
+        user_data['score_states'].pop(country, None)
+        database['high_scores'].set((user_id, country), (0, user_id, country))
+        database['high_scores_daily'].set((user_id, country), (0, user_id, country))
 
         if user_data['nickname_confirmed']:
             send_menu_markup("✅ Cool, your estimate has been saved.", update)
@@ -377,11 +446,13 @@ def do_link(update, context):
     if "username" in update.message.text.lower():
         database['users'][user_id]['nickname'] = f"@{update.message.from_user.username}"
         database['users'][user_id]['nickname_confirmed'] = True
+        invalidate_high_scores(user_id)
         send_menu_markup("✅ Your choice was saved.", update)
         return constants.MENU
     elif "hidden" in update.message.text.lower():
         database['users'][user_id]['nickname'] = "<hidden>"
         database['users'][user_id]['nickname_confirmed'] = True
+        invalidate_high_scores(user_id)
         send_menu_markup("✅ Your choice was saved.", update)
         return constants.MENU
     elif "nickname" in update.message.text.lower():
@@ -407,6 +478,7 @@ def custom_nickname(update, _):
     user_id = update.message.from_user.id
     database['users'][user_id]['nickname'] = new_nickname
     database['users'][user_id]['nickname_confirmed'] = True
+    invalidate_high_scores(user_id)
 
     send_menu_markup("✅ Your choice was saved.", update)
     return constants.MENU
@@ -478,6 +550,15 @@ def change_preferences(update, context):
         return fancy_error(update, context)
 
 
+def invalidate_high_scores(user_id):
+    """
+    Drop the rendered top 10 of all high scores views that list the user, e.g. after the nickname changed.
+    """
+    for view, (*_, top) in list(rendered_high_scores.items()):
+        if any(user_id_ == user_id for user_id_, _ in top):
+            rendered_high_scores.pop(view, None)
+
+
 def high_scores(update, context):
     global database
     if "back" in update.message.text.lower():
@@ -504,17 +585,22 @@ def high_scores(update, context):
          }[user_data['high_scores_view']]
     ]
 
-    formatted_highscores = []
-    for i, (score, user_id_, country) in enumerate(highscores, start=1):
-        if user_id_ == user_id:
-            formatted_highscores.append(
-                f"#{i} {get_flag(country)} {score:.3f}: {database['users'][user_id_]['nickname']} <-- you")
-        elif i <= 10:
+    # the top 10 only change with the leaderboard or the nickname of a listed user
+    rendered = rendered_high_scores.get(user_data['high_scores_view'])
+    if rendered is None or rendered[0] is not highscores or rendered[1] != highscores.version:
+        top = []
+        for i, (score, user_id_, country) in enumerate(highscores[:10], start=1):
             try:
-                formatted_highscores.append(
-                    f"#{i} {get_flag(country)} {score:.3f}: {database['users'][user_id_]['nickname']}")
+                nickname = database['users'][user_id_]['nickname']
             except KeyError:
-                formatted_highscores.append(f"#{i} {get_flag(country)} {score:.3f}: <deleted user>")
+                nickname = "<deleted user>"
+            top.append((user_id_, f"#{i} {get_flag(country)} {score:.3f}: {nickname}"))
+        rendered = rendered_high_scores[user_data['high_scores_view']] = highscores, highscores.version, top
+
+    formatted_highscores = [line + " <-- you" if user_id_ == user_id else line for user_id_, line in rendered[2]]
+    for i, (score, _, country) in highscores.ranks_of_user(user_id):
+        if i > 10:
+            formatted_highscores.append(f"#{i} {get_flag(country)} {score:.3f}: {user_data['nickname']} <-- you")
 
     headings = {
         'total': "Total Score\n\n",
@@ -591,18 +677,18 @@ def country_details(update, context):
         # noinspection PyTypeChecker
         updater.bot.send_chat_action(update.message.from_user.id, ChatAction.UPLOAD_PHOTO)
         country_predictions = user_data['predictions'][country]
-        temp_lock.acquire()
         try:
-            charts.visualize([country, country], database, constants.TEMP_PATH,
-                             [country_predictions, country_predictions], titles=[f"Daily reported Covid-19-infections "
-                                                                                 f"{'for the whole' if country == 'World' else 'in'} {country}",
-                                                                                 ""], offsets=[[300, 300], [10, 10]])
-            with open(constants.TEMP_PATH, "rb") as f:
-                update.message.reply_photo(
-                    photo=f
-                )
-        finally:
-            temp_lock.release()
+            offload_pool.submit(offload.render_chart,
+                                ([country, country], database.stats, [country_predictions, country_predictions]),
+                                dict(titles=[f"Daily reported Covid-19-infections "
+                                             f"{'for the whole' if country == 'World' else 'in'} {country}", ""],
+                                     offsets=[[300, 300], [10, 10]]),
+                                callback=lambda chart: update.message.reply_photo(
+                                    photo=io.BytesIO(chart)
+                                ),
+                                error_callback=job_failed(update.message.reply_text, "Please select the country again."))
+        except PoolBusy:
+            busy(update.message.reply_text)
         return constants.COUNTRY_DETAILS
     else:
         fancy_error(update, context)
@@ -669,33 +755,44 @@ def group_challenge(update, context, duration: datetime.timedelta):
         'bets': dict(),
     }
 
-    charts.visualize(countries=[configuration['country']], covid_stats=database,
-                     img_path=f"{constants.IMAGES_PATH}/{[configuration['country']]}.jpg", mode="input",
-                     chart_scale=1.1, offsets=[[max(configuration['duration'].days, 30), 7]])
-
-    config_id = update.message.reply_photo(
-        caption="⏳",
-        photo=open(f"{constants.IMAGES_PATH}/{configuration['country']}.jpg", "rb"),
-    ).message_id
-
-    updater.bot.edit_message_caption(
-        chat_id=update.effective_chat.id,
-        message_id=config_id,
-        caption=challenge_text(configuration),
-        parse_mode="MarkdownV2",
-        reply_markup=challenge_markup(update.effective_chat.id, config_id)
-    )
-    database['groups'][update.effective_chat.id]['configurations'][config_id] = configuration
+    def rendered(chart):
+        config_id = update.message.reply_photo(
+            caption="⏳",
+            photo=io.BytesIO(chart),
+        ).message_id
+
+        updater.bot.edit_message_caption(
+            chat_id=update.effective_chat.id,
+            message_id=config_id,
+            caption=challenge_text(configuration),
+            parse_mode="MarkdownV2",
+            reply_markup=challenge_markup(update.effective_chat.id, config_id)
+        )
+        database['groups'][update.effective_chat.id]['configurations'][config_id] = configuration
+
+    try:
+        offload_pool.submit(offload.render_chart,
+                            ([configuration['country']], database.stats),
+                            dict(mode="input", chart_scale=1.1, offsets=[[max(configuration['duration'].days, 30), 7]]),
+                            callback=rendered,
+                            error_callback=job_failed(update.message.reply_text, "Please start the challenge again."))
+    except PoolBusy:
+        busy(update.message.reply_text)
 
 
 def change_challenge_country(update, context):
     configuration = database['groups'][context.user_data['chat_id']]['configurations'][context.user_data['config_id']]
     if update.message.text in constants.SUPPORTED_COUNTRIES:
+        previous_country = configuration['country']
         configuration['country'] = update.message.text[3:]
+        try:
+            update_challenge_chart(configuration, context)
+        except PoolBusy:
+            configuration['country'] = previous_country
+            busy(update.message.reply_text)
+            return
         update.message.reply_text("✅ The country was changed. You can go back now or change it again.")
 
-        update_challenge_chart(configuration, context)
-
         updater.bot.edit_message_caption(
             chat_id=context.user_data['chat_id'],
             message_id=context.user_data['config_id'],
@@ -718,6 +815,11 @@ def change_challenge_country(update, context):
 
 
 def update_challenge_chart(configuration, context=None):
+    """
+    Render the chart of a challenge in a worker and replace the photo of the challenge message with it.
+
+    :raise PoolBusy: if the chart can not be rendered right now
+    """
     if context:
         chat_id = context.user_data['chat_id']
         message_id = context.user_data['config_id']
@@ -727,14 +829,28 @@ def update_challenge_chart(configuration, context=None):
         message_id = configuration['message_id']
         end = configuration['end']
 
-    charts.visualize(countries=[configuration['country']], covid_stats=database,
-                     img_path=f"{constants.IMAGES_PATH}/{configuration['country']}.jpg", mode="input",
-                     chart_scale=1.1, offsets=[[(configuration['duration']).days * 3, 365]], end_date=end)
-    updater.bot.edit_message_media(
-        chat_id=chat_id,
-        message_id=message_id,
-        media=InputMediaPhoto(open(f"{constants.IMAGES_PATH}/{configuration['country']}.jpg", "rb")),
-    )
+    def rendered(chart):
+        try:
+            updater.bot.edit_message_media(
+                chat_id=chat_id,
+                message_id=message_id,
+                media=InputMediaPhoto(io.BytesIO(chart)),
+            )
+        except BadRequest:
+            pass
+        except Unauthorized:
+            if context:
+                raise
+            remove_challenge(configuration['id'])
+            logging.info(f"Challenge {configuration['id']} will be removed.")
+
+    offload_pool.submit(offload.render_chart,
+                        ([configuration['country']], database.stats),
+                        dict(mode="input", chart_scale=1.1, offsets=[[(configuration['duration']).days * 3, 365]],
+                             end_date=end),
+                        callback=rendered,
+                        error_callback=lambda e: logging.error(f"Could not render the chart of challenge "
+                                                               f"{configuration.get('id')}", exc_info=e))
 
 
 def update_challenge_text(configuration):
@@ -786,7 +902,8 @@ def update_challenge_text(configuration):
         remove_challenge(configuration['id'])
         return
 
-    last_date, new_cases = database.get('date', 'new_cases_smoothed', location=configuration['country'])[-1]
+    stats = database.stats
+    last_date, new_cases = stats.get('date', 'new_cases_smoothed', location=configuration['country'])[-1]
 
     text = escape_markdown(f"How many Covid-19-Infections will be reported in"
                            f"{' the whole' if configuration['country'] == 'World' else ''} {configuration['country']} on "
@@ -827,8 +944,8 @@ def update_challenge_text(configuration):
         logging.warning(f"Ignored a BadRequest (updating running challenge details): {e}")
 
     if datetime.date.fromisoformat(last_date) >= configuration['end']:
-        new_cases = database.get('new_cases_smoothed', date=configuration['end'].isoformat(),
-                                 location=configuration['country'])
+        new_cases = stats.get('new_cases_smoothed', date=configuration['end'].isoformat(),
+                              location=configuration['country'])
         new_cases = float(new_cases[0][0])
         score_list = sorted(configuration['bets'].items(), key=lambda i: abs(i[1] - new_cases))
         text = f"The challenge from {(configuration['end'] - configuration['duration']).strftime('%A, %B %d')} with " \
@@ -922,11 +1039,8 @@ def set_challenge_updater(challenge_id, first=True):
     try:
         try:
             update_challenge_chart(database['challenges'][challenge_id])
-        except BadRequest:
-            pass
-        except Unauthorized:
-            remove_challenge(challenge_id)
-            logging.info(f"Challenge {challenge_id} will be removed.")
+        except PoolBusy:
+            logging.warning(f"The chart of challenge {challenge_id} is updated next time.")
         update_challenge_text(database['challenges'][challenge_id])
         logging.info(f"updated challenge {challenge_id}")
     except:
@@ -980,23 +1094,36 @@ def configure_user(query):
     user_data = database['users'][query.from_user.id]
 
     if action == "scale":
+        previous_scale = user_data['chart_scale']
         if param == "inc":
             user_data['chart_scale'] *= 1.5
         elif param == "dec":
             user_data['chart_scale'] /= 1.5
         elif param == "reset":
             user_data['chart_scale'] = 1.5
-        query.answer("✅The chart scale has been changed.")
 
-        caption, reply_markup = prediction_caption(user_data)
+        def edit(photo, caption, reply_markup):
+            query.edit_message_media(
+                media=InputMediaPhoto(photo),
+            )
+            query.edit_message_caption(
+                caption=caption,
+                reply_markup=reply_markup,
+            )
 
-        query.edit_message_media(
-            media=InputMediaPhoto(open(f"{constants.IMAGES_PATH}/{user_data['recent_country']}.jpg", mode="rb")),
-        )
-        query.edit_message_caption(
-            caption=caption,
-            reply_markup=reply_markup,
-        )
+        def failed(text):
+            # the user still sees the chart with the previous scale, unless it has been changed again meanwhile
+            if user_data['chart_scale'] == scale:
+                user_data['chart_scale'] = previous_scale
+            query.message.reply_text(text)
+
+        scale = user_data['chart_scale']
+        try:
+            send_prediction_chart(user_data, edit, failed)
+        except PoolBusy:
+            user_data['chart_scale'] = previous_scale
+            return "⏳ Sorry, there is a lot going on right now. Please try it again in a minute."
+        return "✅The chart scale has been changed."
 
 
 def fancy_error(update, _, type_error=False, internal_error=False):
@@ -1051,6 +1178,16 @@ def upgrade_user_data(users, user_params):
         users[user_id] = user_data
 
 
+def upgrade_high_scores(base):
+    """
+    For compatibility with databases from previous versions, which stored the high scores as sorted lists
+    """
+    for name in ("high_scores", "high_scores_daily", "high_scores_yesterday"):
+        if not isinstance(base[name], Leaderboard):
+            base[name] = Leaderboard.from_entries(base[name])
+            logging.info(f"Converted {name} to a leaderboard.")
+
+
 def update_database():
     """
     Download new Covid-19-statistics and send special types of notifications every 24h.
@@ -1060,18 +1197,32 @@ def update_database():
     if database['scores_update'] != datetime.datetime.now().date():
         logging.info("updating..")
         database.update_stats()
+        stats = database.stats
+
+        # score all predictions at once, grouped by country, continuing from the previous running totals
+        daily_preds = dict()
+        for user_id, user_data in database['users'].items():
+            for country, prediction in user_data['predictions'].items():
+                # predictions from older versions are converted once
+                daily_preds[user_id, country] = user_data['predictions'][country] = as_daily(prediction)
+        states = {(user_id, country): state
+                  for user_id, user_data in database['users'].items()
+                  for country, state in user_data['score_states'].items()}
+        results = score_all(daily_preds, stats, states, database['score_checksums'], constants.SCORING_WORKERS)
 
         highscores, highscores_daily, highscores_yesterday = [], [], []
         for user_id, user_data in database['users'].items():
             persistency_countries = []
             persistency_dates = []
-            for country, prediction in user_data['predictions'].items():
-                daily_pred = get_daily(prediction)
-                score, scores_daily, score_yesterday, days = get_score(country, database, daily_pred)
-                highscores.append((score, user_id, country))
+            for country in user_data['predictions'].keys():
+                daily_pred = daily_preds[user_id, country]
+                score, scores_daily, score_yesterday, days = results[user_id, country]
+                user_data['score_states'][country] = ScoreState(score, days, daily_pred.start + days - 1,
+                                                                score_yesterday)
+                highscores.append(((user_id, country), (score, user_id, country)))
                 if days > constants.N_DAYS_FOR_DAILY:
-                    highscores_daily.append((scores_daily, user_id, country))
-                highscores_yesterday.append((score_yesterday, user_id, country))
+                    highscores_daily.append(((user_id, country), (scores_daily, user_id, country)))
+                highscores_yesterday.append(((user_id, country), (score_yesterday, user_id, country)))
                 user_data['scores'][country], user_data['scores_daily'][country] = score, scores_daily
 
                 if country in user_data['persistency_notification_sent']:
@@ -1080,13 +1231,13 @@ def update_database():
                             user_data['scores_persistent'][country] = score
                     except KeyError:
                         user_data['scores_persistent'][country] = score
-                elif (date2num(datetime.datetime.now()) - list(daily_pred.keys())[0]) > \
+                elif (date2num(datetime.datetime.now()) - daily_pred.start) > \
                         constants.N_DAYS_FOR_PERSISTENCY:
                     persistency_countries.append(country)
-                    persistency_dates.append(num2date(list(daily_pred.keys())[-1]))
+                    persistency_dates.append(num2date(daily_pred.dates[-1]))
             for country, score in user_data['scores_persistent'].items():
                 if abs(score-user_data['scores'][country]) > 1:
-                    highscores.append((score, user_id, country))
+                    highscores.append(((user_id, country, "persistent"), (score, user_id, country)))
             try:
                 if len(persistency_countries) > 1:
                     countries = "\n".join(persistency_countries)
@@ -1106,7 +1257,7 @@ def update_database():
                              f"prediction for {country} exceeded an age of {constants.N_DAYS_FOR_PERSISTENCY} days. "
                              f"From now on, your score ({score:.2f}) will be saved to the High Scores even if you "
                              f"overwrite your prediction.\n\nIf you do not give a new prediction, your score for "
-                             f"{country} will freeze on {num2date(list(daily_pred.keys())[-1]).strftime('%A, %B %d')}."
+                             f"{country} will freeze on {num2date(daily_pred.dates[-1]).strftime('%A, %B %d')}."
                     )
                 for country in persistency_countries:
                     user_data['persistency_notification_sent'].append(country)
@@ -1115,12 +1266,18 @@ def update_database():
                 logging.error(f"Could not send persistency notification for user {user_id} and country {country}.")
             except:
                 logging.exception("While updating persistency notifications:")
-        for h in (highscores, highscores_daily, highscores_yesterday):
-            h.sort(reverse=True, key=lambda x: x[0])
 
-        database['high_scores'] = highscores
-        database['high_scores_daily'] = highscores_daily
-        database['high_scores_yesterday'] = highscores_yesterday
+        database['high_scores'] = Leaderboard(highscores)
+        database['high_scores_daily'] = Leaderboard(highscores_daily)
+        database['high_scores_yesterday'] = Leaderboard(highscores_yesterday)
+
+        # keep a compact daily snapshot of every view for the rank history
+        for view, name in (("total", "high_scores"), ("daily", "high_scores_daily"),
+                           ("yesterday", "high_scores_yesterday")):
+            try:
+                SnapshotArchive(constants.HIGH_SCORES_HISTORY_PATH, view).append(datetime.date.today(), database[name])
+            except OSError as e:
+                logging.error(f"Could not archive the {view} high scores: {e}")
         database['scores_update'] = datetime.datetime.now().date()
 
     # send pending messages
@@ -1143,6 +1300,7 @@ def update_database():
                     except (Unauthorized, BadRequest):
                         try:
                             del users[user_id]
+                            invalidate_high_scores(user_id)
                             logging.info(f"Removed user {user_id}")
                         except:
                             logging.error(f"Could not remove {user_id}")
@@ -1168,23 +1326,20 @@ def update_database():
                                 user_data['limits_note'] = True
                             else:
                                 note = ""
-                            temp_lock.acquire()
-                            try:
-                                charts.visualize(user_data['predictions'].keys(), database, constants.TEMP_PATH,
-                                                 user_data['predictions'].values())
-                                # send uncompressed
-                                with open(constants.TEMP_PATH, "rb") as f:
-                                    updater.bot.send_document(
-                                        chat_id=user_id,
-                                        document=f,
-                                        caption=f"{random.choice(constants.GREETINGS)} {chat.first_name}, here is your prediction report!{note}"
-                                    )
-                            finally:
-                                temp_lock.release()
+                            report = io.BytesIO()
+                            charts.visualize(user_data['predictions'].keys(), database.stats, report,
+                                             user_data['predictions'].values())
+                            # send uncompressed
+                            updater.bot.send_document(
+                                chat_id=user_id,
+                                document=report,
+                                caption=f"{random.choice(constants.GREETINGS)} {chat.first_name}, here is your prediction report!{note}"
+                            )
                             user_data['last_scheduled_update'] = datetime.date.today()
                         except (Unauthorized, BadRequest):
                             try:
                                 del users[user_id]
+                                invalidate_high_scores(user_id)
                                 logging.info(f"Removed user {user_id}")
                             except:
                                 logging.error(f"Could not remove {user_id}")
@@ -1264,7 +1419,8 @@ if __name__ == "__main__":
     warnings.filterwarnings("ignore",
                             message="Starting a Matplotlib GUI outside of the main thread will likely fail.")
 
-    temp_lock = threading.Semaphore()
+    # view: (leaderboard, version of the leaderboard, [(user id, formatted line)] of the top 10)
+    rendered_high_scores = dict()
 
     MENU_OPTIONS = {
         "➕ New Prediction": select_country,
@@ -1284,6 +1440,9 @@ if __name__ == "__main__":
         logging.info("Starting with real token")
         test_environment = DEBUG_SCORES = False
 
+    offload_pool = Offload(constants.OFFLOAD_WORKERS, constants.OFFLOAD_MAX_PENDING,
+                           constants.OFFLOAD_MAX_TASKS_PER_CHILD, constants.OFFLOAD_TIMEOUT)
+
     updater = Updater(token=token,
                       use_context=True,
                       workers=0)
@@ -1293,9 +1452,10 @@ if __name__ == "__main__":
         CPGameData({
             'scores_update': None,
             'users': dict(),
-            'high_scores': [],
-            'high_scores_daily': [],
-            'high_scores_yesterday': [],
+            'high_scores': Leaderboard(),
+            'high_scores_daily': Leaderboard(),
+            'high_scores_yesterday': Leaderboard(),
+            'score_checksums': dict(),
             'groups': dict(),
             'challenges': dict(),
         })
@@ -1304,6 +1464,7 @@ if __name__ == "__main__":
         database['users'],
         {
             'chart_scale': 1.5,
+            'drawing_reference': None,
             'high_scores_view': "total",
             'last_conversation_state': constants.MENU,
             'last_scheduled_update': None,
@@ -1313,9 +1474,11 @@ if __name__ == "__main__":
             'scheduled_updates_interval': None,
             'scores_daily': dict(),
             'scores_persistent': dict(),
+            'score_states': dict(),
             'update_notifications': True,
         }
     )
+    upgrade_high_scores(database)
 
     update_database()
 
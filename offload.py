@@ -0,0 +1,254 @@
+import collections
+import io
+import logging
+import multiprocessing.connection
+import threading
+import time
+import warnings
+
+import charts
+import data
+import line_detection
+
+
+class PoolBusy(Exception):
+    """Raised if too many jobs are waiting for a worker."""
+
+
+class JobTimeout(Exception):
+    """Passed to the error callback if a job did not finish in time."""
+
+
+class Offload:
+    """
+    Runs CPU-bound jobs (line detection and chart rendering) in worker processes, so that they do not block the bot.
+
+    Results are passed to callbacks, which run in their own threads. The number of unfinished jobs is bounded; if it is
+    reached, submit raises PoolBusy right away instead of queueing the job. The timeout of a job starts when a worker
+    picks it up. A worker whose job does not finish in time is killed and replaced, the jobs of the other workers are
+    not affected. Workers are also replaced after a number of jobs to release the memory matplotlib accumulates. With 0
+    workers, jobs are run directly in the calling thread.
+    """
+
+    def __init__(self, workers: int, max_pending: int, max_tasks_per_child: int, timeout: float):
+        self.max_tasks_per_child = max_tasks_per_child
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self._lock = threading.Lock()
+        self._queue = collections.deque()  # jobs waiting for a worker
+        self._closed = False
+        self._workers = []
+        if workers > 0:
+            self._context = data.worker_context()
+            # wakes up the manager thread when a job is submitted
+            self._wake_receiver, self._wake_sender = self._context.Pipe(duplex=False)
+            self._workers = [_Worker(self._context) for _ in range(workers)]
+            threading.Thread(target=self._manage, name="offload", daemon=True).start()
+
+    def submit(self, func, args=(), kwargs=None, callback=None, error_callback=None, timeout=None):
+        """
+        Run func(*args, **kwargs) in a worker.
+
+        :param callback: called with the result of the job
+        :param error_callback: called with the exception if the job failed or did not finish within the timeout
+        :param timeout: seconds a worker may spend on the job, the default timeout of the pool by default
+        :raise PoolBusy: if too many jobs are unfinished
+        """
+        if not self._workers:
+            try:
+                result = func(*args, **(kwargs or {}))
+            except Exception as e:
+                _run(error_callback, e)
+            else:
+                _run(callback, result)
+            return
+
+        if not self._slots.acquire(blocking=False):
+            raise PoolBusy("Too many jobs are waiting for a worker.")
+        with self._lock:
+            self._queue.append(_Job(func, args, kwargs or {}, callback, error_callback, timeout or self.timeout))
+            self._wake_sender.send_bytes(b"")
+
+    def _manage(self):
+        """Pass the queued jobs to idle workers and collect their results, replacing workers that time out."""
+        while True:
+            with self._lock:
+                if self._closed:
+                    for worker in self._workers:
+                        worker.stop()
+                    return
+                for worker in self._workers:
+                    while worker.ready and worker.job is None and self._queue:
+                        self._start(worker, self._queue.popleft())
+                busy = [worker for worker in self._workers if worker.job is not None or not worker.ready]
+
+            deadline = min((worker.deadline for worker in busy if worker.job is not None), default=None)
+            ready = multiprocessing.connection.wait(
+                [self._wake_receiver] + [worker.connection for worker in busy],
+                None if deadline is None else max(deadline - time.monotonic(), 0))
+
+            for worker in busy:
+                if not worker.ready:
+                    if worker.connection in ready:
+                        # the worker has started up and sent None, or exited
+                        try:
+                            worker.connection.recv()
+                        except (EOFError, OSError):
+                            self._replace(worker)
+                        else:
+                            worker.ready = True
+                elif worker.connection in ready:
+                    job = worker.job
+                    worker.job = None
+                    try:
+                        succeeded, result = worker.connection.recv()
+                    except (EOFError, OSError):
+                        self._replace(worker)
+                        self._finish(job.error_callback, RuntimeError(f"The worker running {job.func.__name__} "
+                                                                      f"exited."))
+                        continue
+                    worker.tasks += 1
+                    if worker.tasks >= self.max_tasks_per_child:
+                        self._replace(worker)
+                    self._finish(job.callback if succeeded else job.error_callback, result)
+                elif worker.deadline <= time.monotonic():
+                    job = worker.job
+                    worker.job = None
+                    logging.warning(f"{job.func.__name__} did not finish within {job.timeout} seconds, replacing the "
+                                    f"worker.")
+                    self._replace(worker)
+                    self._finish(job.error_callback, JobTimeout(f"{job.func.__name__} did not finish within "
+                                                                f"{job.timeout} seconds."))
+            if self._wake_receiver in ready:
+                self._wake_receiver.recv_bytes()
+
+    def _start(self, worker, job):
+        try:
+            worker.connection.send((job.func, job.args, job.kwargs))
+        except (OSError, ValueError) as e:
+            # the worker exited while it was idle
+            self._replace(worker)
+            self._finish(job.error_callback, e)
+            return
+        worker.job = job
+        worker.deadline = time.monotonic() + job.timeout
+
+    def _replace(self, worker):
+        worker.stop()
+        if not self._closed:
+            self._workers[self._workers.index(worker)] = _Worker(self._context)
+
+    def _finish(self, func, arg):
+        self._slots.release()
+        _reply(func, arg)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._workers:
+                # the manager thread stops the workers
+                self._wake_sender.send_bytes(b"")
+
+
+class _Job:
+    def __init__(self, func, args: tuple, kwargs: dict, callback, error_callback, timeout: float):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.error_callback = error_callback
+        self.timeout = timeout
+
+
+class _Worker:
+    """A worker process and the end of its pipe, jobs are sent and results received through it one at a time."""
+
+    def __init__(self, context):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=work, args=(child_connection,), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.ready = False
+        self.job = None
+        self.deadline = None
+        self.tasks = 0
+
+    def stop(self):
+        self.process.kill()
+        self.connection.close()
+
+
+def work(connection):
+    """Run the jobs received through the connection and send back (True, result) or (False, exception)."""
+    init_worker()
+    # jobs are only timed once the worker is ready, starting it takes a few seconds
+    connection.send(None)
+    while True:
+        try:
+            func, args, kwargs = connection.recv()
+        except EOFError:
+            return
+        try:
+            result = True, func(*args, **kwargs)
+        except Exception as e:
+            result = False, e
+        try:
+            connection.send(result)
+        except Exception as e:
+            # the result could not be pickled
+            connection.send((False, RuntimeError(f"Could not return the result of {func.__name__}: {e}")))
+
+
+def _reply(func, arg):
+    # don't hold up the results of other jobs while replying
+    threading.Thread(target=_run, args=(func, arg), daemon=True).start()
+
+
+def _run(func, arg):
+    if func is None:
+        return
+    try:
+        func(arg)
+    except Exception:
+        logging.exception(f"Callback {getattr(func, '__name__', func)} failed:")
+
+
+def init_worker():
+    logging.basicConfig(format='%(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    warnings.filterwarnings("ignore", message="Starting a Matplotlib GUI outside of the main thread will likely fail.")
+
+
+# jobs, their arguments and results are exchanged with the workers, so images are passed as bytes
+
+def render_chart(countries: list, covid_stats, *args, **kwargs) -> bytes:
+    """Render a chart (see charts.visualize) and return the JPEG image."""
+    chart = io.BytesIO()
+    charts.visualize(countries, covid_stats, chart, *args, **kwargs)
+    return chart.getvalue()
+
+
+def render_input_chart(country: str, covid_stats, chart_scale: float) -> (bytes, tuple, object):
+    """Render the chart users draw their prediction on and return the image, the drawing area and the decoded image."""
+    chart = io.BytesIO()
+    drawing_area = charts.visualize([country], covid_stats, chart, mode="input", chart_scale=chart_scale)
+    return chart.getvalue(), drawing_area, line_detection.decode_reference(chart)
+
+
+def detect_line(photo: bytes, country: str, drawing_area: tuple, covid_stats, reference,
+                chart_scale: float) -> (object, bytes, object):
+    """
+    Detect the drawn line in a photo and render a chart of the detected prediction for confirmation.
+
+    :param reference: decoded input chart the line was drawn on, None to render it again from the same data
+    :return: prediction (or an error message), image of the confirmation chart (or None) and the input chart that was
+        rendered again (or None)
+    """
+    rendered = None
+    if reference is None:
+        _, _, rendered = render_input_chart(country, covid_stats, chart_scale)
+    prediction = line_detection.evaluate(io.BytesIO(photo), country, drawing_area, covid_stats,
+                                         reference if rendered is None else rendered)
+    if type(prediction) == str:
+        return prediction, None, rendered
+    return prediction, render_chart([country], covid_stats, [prediction], mode="confirmation",
+                                    chart_scale=chart_scale), rendered
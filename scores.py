@@ -1,55 +1,300 @@
-import datetime
 import logging
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
 
-from matplotlib.dates import date2num
+import numpy as np
 
+import data
 
-def get_daily(prediction: dict) -> dict:
+
+# version of the DailyPrediction records stored in the database
+PREDICTION_VERSION = 1
+
+
+class DailyPrediction(NamedTuple):
+    """Predicted numbers of cases for consecutive days, starting at the date number start."""
+    start: int
+    values: np.ndarray
+    version: int = PREDICTION_VERSION
+
+    @property
+    def dates(self) -> np.ndarray:
+        """Date numbers of all predicted days."""
+        return np.arange(self.start, self.start + len(self.values))
+
+    def values_at(self, dates: np.ndarray) -> np.ndarray:
+        """Return the predicted values for the given date numbers (NaN for days that were not predicted)."""
+        dates = np.asarray(dates, dtype=np.float64)
+        indices = dates - self.start
+        predicted = (indices >= 0) & (indices < len(self.values)) & (indices == np.round(indices))
+        res = np.full(len(dates), np.nan)
+        res[predicted] = self.values[indices[predicted].astype(np.int64)]
+        return res
+
+
+class ScoreState(NamedTuple):
+    """Running totals of a prediction that has been scored up to (and including) the date number last_day."""
+    score: float
+    days: int
+    last_day: int
+    last_score: float
+
+
+def interpolate(prediction: dict) -> DailyPrediction:
     """Convert a raw prediction into a series of numbers, one for each predicted day."""
-    current_date, *_, end_date = dates = list(prediction.keys())
-    index = 0
-    daily_predictions = dict()
+    dates = np.fromiter(prediction.keys(), dtype=np.float64, count=len(prediction))
+    values = np.fromiter(prediction.values(), dtype=np.float64, count=len(prediction))
+    start, end = dates[0], dates[-1]
 
     # bugfix for older profiles
     if dates[0] > dates[1]:
-        current_date = dates[1]
-
-    while current_date < end_date:
-        if current_date > dates[index + 1]:
-            index += 1
-        else:
-            timespan = dates[index + 1] - dates[index]
-            weight1 = dates[index + 1] - current_date
-            weight2 = current_date - dates[index]
-            cases = (prediction[dates[index]] * weight1 + prediction[dates[index + 1]] * weight2) / timespan
-
-            if cases < 0: cases = 0
-
-            daily_predictions[int(current_date)] = cases
-            current_date += 1
-    return daily_predictions
-
-
-def get_score(country, covid_stats, daily_predictions: dict) -> (float, float, float):
-    """Get the total and daily score of a user."""
-    data = covid_stats.get("date", "new_cases_smoothed", location=country)
-    score = days = last_score = 0
-    for i, (date_pred, cases_pred) in enumerate(daily_predictions.items()):
-        for date_actual, cases_actual in data:
-            if date_pred == date2num(datetime.date.fromisoformat(date_actual)):
-                try:
-                    cases_actual = float(cases_actual)
-                except ValueError:
-                    logging.error(
-                        f"No valid data for {country} available.")
-                else:
-                    if cases_actual == 0 or cases_pred == 0:
-                        last_score = cases_actual == cases_pred
-                    else:
-                        last_score = min(cases_actual / cases_pred,cases_pred / cases_actual)
-                    score += last_score
-                    days += 1
-                    break
-        else:
-            break
-    return float(score), float(score)/(days if score else 1), float(last_score), days
+        start = dates[1]
+        dates, values = dates[1:], values[1:]
+
+    # if the line was drawn beyond the end of the prediction, the remaining points are never reached
+    decreasing = np.flatnonzero(dates[1:] <= dates[:-1])
+    if len(decreasing):
+        dates, values = dates[:decreasing[0] + 1], values[:decreasing[0] + 1]
+
+    daily = np.interp(np.arange(start, end), dates, values)
+    return DailyPrediction(int(start), np.maximum(daily, 0).astype(np.float32))
+
+
+# conversions of a stored prediction to the next version, the raw dictionaries of older databases are version 0
+MIGRATIONS = {
+    0: interpolate,
+}
+
+
+def as_daily(prediction) -> DailyPrediction:
+    """
+    Return the daily series of a prediction, migrating it to PREDICTION_VERSION.
+
+    Predictions are stored as DailyPrediction since version 1, older databases still contain the raw dictionaries
+    returned by line_detection.evaluate, which are interpolated.
+
+    :raise ValueError: if the prediction was stored by a newer version
+    """
+    version = prediction.version if isinstance(prediction, DailyPrediction) else 0
+    if version > PREDICTION_VERSION:
+        raise ValueError(f"Predictions of version {version} are not supported (latest: {PREDICTION_VERSION}).")
+    while version < PREDICTION_VERSION:
+        prediction = MIGRATIONS[version](prediction)
+        version = prediction.version
+    return prediction
+
+
+def get_daily(prediction: dict) -> dict:
+    """Convert a raw prediction into a dictionary date: cases with one item for each predicted day."""
+    daily = interpolate(prediction)
+    return dict(zip(range(daily.start, daily.start + len(daily.values)), daily.values.tolist()))
+
+
+def get_score(country, covid_stats, daily_predictions) -> (float, float, float):
+    """
+    Get the total and daily score of a user.
+
+    :param daily_predictions: DailyPrediction or dictionary date: cases as returned by get_daily
+
+    Predicted days are aligned with the reported ones by their date. Scoring stops at the first predicted day without
+    valid data. For every scored day, the smaller ratio between the predicted and the reported number of cases is
+    added; the ratios are summed up in order, so the result is the same as when adding them one by one.
+    """
+    series = covid_stats.get_series(country)
+    if isinstance(daily_predictions, DailyPrediction):
+        dates = daily_predictions.dates.astype(np.float64)
+        predicted = daily_predictions.values.astype(np.float64)
+    else:
+        dates = np.fromiter(daily_predictions.keys(), dtype=np.float64, count=len(daily_predictions))
+        predicted = np.fromiter(daily_predictions.values(), dtype=np.float64, count=len(daily_predictions))
+
+    rows = np.searchsorted(series.dates, dates)
+    found = rows < len(series)
+    found[found] = series.dates[rows[found]] == dates[found]
+    actual = np.full(len(dates), np.nan)
+    actual[found] = series.values[rows[found]]
+
+    valid = ~np.isnan(actual)
+    days = len(valid) if valid.all() else int(np.argmin(valid))
+    if days < len(valid) and found[days]:
+        logging.error(
+            f"No valid data for {country} available.")
+    if not days:
+        return 0.0, 0.0, 0.0, 0
+
+    actual, predicted = actual[:days], predicted[:days]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = np.minimum(actual / predicted, predicted / actual)
+    zero = (actual == 0) | (predicted == 0)
+    ratios[zero] = actual[zero] == predicted[zero]
+
+    score = float(np.cumsum(ratios)[-1])
+    return score, score / (days if score else 1), float(ratios[-1]), days
+
+
+def score_batch(country, covid_stats, predictions: list, states: list = None, chunk_size=1024) -> (
+        np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    """
+    Score many predictions for the same country at once.
+
+    The predictions are stacked into a matrix (predictions x days) that is compared with the reported cases in one
+    pass. The rules are the same as in get_score, and so are the results.
+
+    :param predictions: list of DailyPrediction
+    :param states: ScoreState of each prediction (or None) to continue after the days that have already been scored,
+        states that do not match the start of their prediction are ignored
+    :param chunk_size: maximum number of predictions processed in one matrix, limits the memory usage
+    :return: arrays with the total score, average score, score of the last day and number of scored days for each
+        prediction
+    """
+    if not predictions:
+        return np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64)
+    if states is None:
+        states = [None] * len(predictions)
+
+    # days after the last reported one can't be scored yet
+    series = covid_stats.get_series(country)
+    end = int(series.dates[-1]) + 1 if len(series) else 0
+
+    totals, lasts, days = np.zeros(len(predictions)), np.zeros(len(predictions)), np.zeros(len(predictions), np.int64)
+    remaining = []
+    for i, (prediction, state) in enumerate(zip(predictions, states)):
+        if state is not None and state.last_day - state.days + 1 == prediction.start:
+            totals[i], lasts[i], days[i] = state.score, state.last_score, state.days
+        skip = int(days[i])
+        remaining.append(DailyPrediction(prediction.start + skip,
+                                         prediction.values[skip:max(skip, end - prediction.start)]))
+
+    # predictions with similar start dates are processed together to keep the matrices narrow
+    active = np.array([i for i, prediction in enumerate(remaining) if len(prediction.values)], dtype=np.int64)
+    active = active[np.argsort([remaining[i].start for i in active], kind="stable")]
+    for j in range(0, len(active), chunk_size):
+        chunk = active[j:j + chunk_size]
+        new_totals, new_lasts, new_days = _score_chunk(country, series, [remaining[i] for i in chunk], totals[chunk])
+        totals[chunk] = new_totals
+        lasts[chunk] = np.where(new_days > 0, new_lasts, lasts[chunk])
+        days[chunk] += new_days
+
+    averages = totals / np.where(totals != 0, days, 1)
+    return totals, averages, lasts, days
+
+
+def _score_chunk(country, series, predictions: list, initial: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    starts = np.array([prediction.start for prediction in predictions], dtype=np.int64)
+    lengths = np.array([len(prediction.values) for prediction in predictions], dtype=np.int64)
+    first_day = int(starts.min())
+    width = max(int((starts + lengths).max()) - first_day, 1)
+
+    # scatter all predictions into one matrix aligned on the days since first_day
+    rows = np.repeat(np.arange(len(predictions)), lengths)
+    columns = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + \
+        np.repeat(starts - first_day, lengths)
+    predicted = np.zeros((len(predictions), width))
+    predicted[rows, columns] = np.concatenate([prediction.values for prediction in predictions])
+    in_range = np.zeros((len(predictions), width), dtype=bool)
+    in_range[rows, columns] = True
+
+    dates = np.arange(first_day, first_day + width, dtype=np.float64)
+    series_rows = np.searchsorted(series.dates, dates)
+    found = series_rows < len(series)
+    found[found] = series.dates[series_rows[found]] == dates[found]
+    actual = np.full(width, np.nan)
+    actual[found] = series.values[series_rows[found]]
+
+    # every prediction is scored up to its first day without valid data
+    missing = in_range & np.isnan(actual)
+    first_missing = np.where(missing.any(axis=1), missing.argmax(axis=1), width)
+    if np.any(found[first_missing[first_missing < width]]):
+        logging.error(
+            f"No valid data for {country} available.")
+    counted = in_range & (np.arange(width) < first_missing[:, np.newaxis])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = np.minimum(actual / predicted, predicted / actual)
+    ratios = np.where((actual == 0) | (predicted == 0), actual == predicted, ratios)
+    ratios[~counted] = 0
+
+    # continue the running totals, the ratios are still added one by one
+    days = counted.sum(axis=1)
+    totals = np.cumsum(np.column_stack((initial, ratios)), axis=1)[:, -1]
+    last_days = np.where(days > 0, starts - first_day + days - 1, 0)
+    lasts = np.where(days > 0, ratios[np.arange(len(predictions)), last_days], 0)
+    return totals, lasts, days
+
+
+def check_history(country, covid_stats, checksums: dict) -> bool:
+    """
+    Check whether the reported cases of a country are unchanged since it was scored the last time.
+
+    Past values are sometimes revised, in which case running totals have to be discarded.
+
+    :param checksums: dictionary country: (last date number, checksum) that is updated to the current statistics
+    :return: False if the country was not checked before or its values up to the last checked day have changed
+    """
+    series = covid_stats.get_series(country)
+
+    def checksum(stop):
+        return zlib.crc32(series.values[:stop].tobytes(), zlib.crc32(series.ordinals[:stop].tobytes()))
+
+    unchanged = False
+    if country in checksums:
+        last_day, previous = checksums[country]
+        unchanged = checksum(int(np.searchsorted(series.dates, last_day, side="right"))) == previous
+    if len(series):
+        checksums[country] = int(series.dates[-1]), checksum(len(series))
+    else:
+        checksums.pop(country, None)
+    return unchanged
+
+
+def score_all(predictions: dict, covid_stats, states: dict = None, checksums: dict = None, workers=0) -> dict:
+    """
+    Score the predictions of all users, grouped by country.
+
+    :param predictions: dictionary (user id, country): DailyPrediction
+    :param states: dictionary (user id, country): ScoreState to only score the days that were not scored before
+    :param checksums: dictionary country: (last date number, checksum) as used by check_history, states are only used
+        for countries whose reported cases have not been revised
+    :param workers: number of processes the users are distributed to, 0 to score all predictions in this process
+    :return: dictionary (user id, country): (score, average score, score of the last day, number of scored days)
+    """
+    if states is not None and checksums is not None:
+        revised = [country for country in dict.fromkeys(key[1] for key in predictions)
+                   if not check_history(country, covid_stats, checksums)]
+        for country in revised:
+            logging.info(f"Rescoring all predictions for {country}.")
+        states = {key: state for key, state in states.items() if key[1] not in revised}
+    if workers < 1:
+        return _score_shard(predictions, covid_stats, states)
+
+    # every worker gets a contiguous range of users, the statistics are memory-mapped from their cache
+    users = list(dict.fromkeys(key[0] for key in predictions))
+    shard_of = {user_id: i * workers // len(users) for i, user_id in enumerate(users)}
+    shards = [(dict(), dict()) for _ in range(workers)]
+    for key, prediction in predictions.items():
+        shards[shard_of[key[0]]][0][key] = prediction
+        if states is not None and key in states:
+            shards[shard_of[key[0]]][1][key] = states[key]
+
+    res = dict()
+    with ProcessPoolExecutor(workers, mp_context=data.worker_context()) as executor:
+        futures = [executor.submit(_score_shard, shard, covid_stats, shard_states if states is not None else None)
+                   for shard, shard_states in shards if shard]
+        for future in futures:
+            res.update(future.result())
+    return res
+
+
+def _score_shard(predictions: dict, covid_stats, states: dict = None) -> dict:
+    groups = dict()
+    for key in predictions:
+        groups.setdefault(key[1], []).append(key)
+
+    res = dict()
+    for country, keys in groups.items():
+        results = score_batch(country, covid_stats, [predictions[key] for key in keys],
+                              [states.get(key) for key in keys] if states is not None else None)
+        for key, score, average, last_score, days in zip(keys, *(array.tolist() for array in results)):
+            res[key] = score, average, last_score, days
+    return res